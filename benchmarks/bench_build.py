@@ -0,0 +1,260 @@
+#!/usr/bin/env python3
+"""
+Benchmark sphinxcontrib-mermaid on synthetic projects.
+
+Generates a project with ``--pages`` pages of ``--diagrams`` diagrams each,
+mixing inline, file-based and ``autoclasstree`` diagrams, builds it with the
+HTML builder and reports:
+
+- read and write phase wall time,
+- time spent in ``install_js`` per page,
+- HTML bytes per page,
+- peak RSS of the build and of the renderer processes.
+
+Build-time formats (``--format svg`` or ``png``) render through
+``mmdc_stub.py``, which sleeps ``--latency`` seconds per diagram instead of
+launching a browser, so the benchmark runs offline. Example::
+
+    python benchmarks/bench_build.py --pages 200 --diagrams 5 --format svg
+
+Results saved with ``--output`` serve as the ``--baseline`` of a later run,
+for instance with the base branch installed: the run prints a Markdown table
+of the differences and exits with status 1 when a metric got worse by more
+than ``--tolerance``. Timings vary between runs, ``--repeat`` keeps the
+fastest of several builds.
+"""
+
+from __future__ import annotations
+
+import argparse
+import json
+import multiprocessing
+import os
+import statistics
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from tempfile import TemporaryDirectory
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+from sphinx.application import Sphinx
+
+import sphinxcontrib.mermaid
+
+STUB = Path(__file__).parent / "mmdc_stub.py"
+
+CONF = """\
+import sys
+
+extensions = ["sphinxcontrib.mermaid"]
+mermaid_output_format = {fmt!r}
+mermaid_cmd = [sys.executable, {stub!r}]
+"""
+
+#: Results compared against a baseline; lower is better for all of them. The
+#: build time is compared as a whole, its phases are too short to be stable.
+COMPARED = ("build_s", "install_js_mean_ms", "html_bytes_mean", "peak_rss_mb", "renderer_peak_rss_mb")
+
+#: Timings taken from the fastest of ``--repeat`` runs.
+TIMINGS = ("build_s", "read_s", "write_s", "install_js_mean_ms", "install_js_max_ms")
+
+#: Results that must match for a baseline to be comparable.
+PARAMETERS = ("pages", "diagrams_per_page", "format")
+
+AUTOCLASSTREE_TARGETS = ["collections.OrderedDict", "json.JSONDecodeError", "sphinx.errors", "docutils.nodes.Element"]
+
+
+def flowchart(seed, size):
+    lines = ["flowchart LR"]
+    lines.extend(f"   n{seed}_{i}[Node {i}] --> n{seed}_{i + 1}[Node {i + 1}]" for i in range(size))
+    return "\n".join(lines)
+
+
+def generate_project(srcdir, pages, diagrams, size, zoom_every):
+    """Write a synthetic project into ``srcdir``."""
+    srcdir.mkdir(parents=True, exist_ok=True)
+    (srcdir / "diagrams").mkdir(exist_ok=True)
+    toctree = "\n".join(f"   page{p}" for p in range(pages))
+    (srcdir / "index.rst").write_text(f"Benchmark\n=========\n\n.. toctree::\n\n{toctree}\n", encoding="utf-8")
+
+    for p in range(pages):
+        body = [f"Page {p}", "=" * (5 + len(str(p))), ""]
+        for d in range(diagrams):
+            seed = p * diagrams + d
+            kind = seed % 3
+            zoom = ["   :zoom:"] if zoom_every and seed % zoom_every == 0 else []
+            if kind == 0:
+                code = flowchart(seed, size).replace("\n", "\n   ")
+                body += [".. mermaid::", *zoom, "", f"   {code}", ""]
+            elif kind == 1:
+                (srcdir / "diagrams" / f"d{seed}.mmd").write_text(flowchart(seed, size), encoding="utf-8")
+                body += [f".. mermaid:: diagrams/d{seed}.mmd", *zoom, ""]
+            else:
+                target = AUTOCLASSTREE_TARGETS[seed % len(AUTOCLASSTREE_TARGETS)]
+                body += [f".. autoclasstree:: {target}", "   :full:", *zoom, ""]
+        (srcdir / f"page{p}.rst").write_text("\n".join(body), encoding="utf-8")
+
+
+def peak_rss_mb(who):
+    if resource is None:
+        return None
+    rss = resource.getrusage(who).ru_maxrss
+    # Kilobytes on Linux, bytes on macOS.
+    return rss / (1024 * 1024 if sys.platform == "darwin" else 1024)
+
+
+def run(args):
+    original_install_js = sphinxcontrib.mermaid.install_js
+    timings_file = None
+
+    def timed_install_js(*a, **kw):
+        start = time.perf_counter()
+        try:
+            return original_install_js(*a, **kw)
+        finally:
+            # With -j, pages are written in forked processes: each appends its
+            # timings to a shared file instead of a list the parent never sees.
+            with open(timings_file, "a", encoding="utf-8") as fp:
+                fp.write(f"{time.perf_counter() - start}\n")
+
+    # setup() connects the module-level name, so patch it before the app exists.
+    sphinxcontrib.mermaid.install_js = timed_install_js
+    os.environ["MMDC_STUB_LATENCY"] = str(args.latency)
+
+    with TemporaryDirectory() as tmp:
+        tmpdir = Path(args.keep) if args.keep else Path(tmp)
+        timings_file = tmpdir / "install_js_times.txt"
+        timings_file.unlink(missing_ok=True)
+        srcdir = tmpdir / "src"
+        outdir = tmpdir / "build" / "html"
+        generate_project(srcdir, args.pages, args.diagrams, args.size, args.zoom_every)
+        (srcdir / "conf.py").write_text(CONF.format(fmt=args.format, stub=str(STUB)), encoding="utf-8")
+
+        marks = {}
+        try:
+            app = Sphinx(
+                str(srcdir),
+                str(srcdir),
+                str(outdir),
+                str(tmpdir / "build" / "doctrees"),
+                "html",
+                status=None,
+                warning=sys.stderr,
+                freshenv=True,
+                parallel=args.jobs,
+            )
+        finally:
+            sphinxcontrib.mermaid.install_js = original_install_js
+
+        def mark(name):
+            def handler(*a):
+                marks.setdefault(name, time.perf_counter())
+
+            return handler
+
+        app.connect("env-before-read-docs", mark("read"))
+        app.connect("env-updated", mark("write"))
+        app.connect("build-finished", mark("end"))
+        app.build(force_all=True)
+
+        page_bytes = [f.stat().st_size for f in outdir.glob("page*.html")]
+        install_js_times = [float(line) for line in timings_file.read_text(encoding="utf-8").split()] if timings_file.exists() else []
+
+    results = {
+        "pages": args.pages,
+        "diagrams_per_page": args.diagrams,
+        "format": args.format,
+        "build_s": marks["end"] - marks["read"],
+        "read_s": marks["write"] - marks["read"],
+        "write_s": marks["end"] - marks["write"],
+        "install_js_calls": len(install_js_times),
+        "install_js_mean_ms": statistics.mean(install_js_times) * 1000 if install_js_times else 0.0,
+        "install_js_max_ms": max(install_js_times, default=0.0) * 1000,
+        "html_bytes_mean": statistics.mean(page_bytes) if page_bytes else 0,
+        "html_bytes_max": max(page_bytes, default=0),
+        "peak_rss_mb": peak_rss_mb(resource.RUSAGE_SELF) if resource else None,
+        "renderer_peak_rss_mb": peak_rss_mb(resource.RUSAGE_CHILDREN) if resource else None,
+    }
+    return results
+
+
+def compare(results, baseline, tolerance):
+    """Print a Markdown table of ``results`` against ``baseline``.
+
+    Returns the metrics that got worse by more than ``tolerance``, a fraction
+    of the baseline value.
+    """
+    regressions = []
+    print("| metric | baseline | current | change |")
+    print("| --- | ---: | ---: | ---: |")
+    for key in COMPARED:
+        old, new = baseline.get(key), results.get(key)
+        # Missing, or zero like the renderer RSS when nothing is rendered.
+        if not old or new is None:
+            continue
+        change = new / old - 1
+        mark = ""
+        if change > tolerance:
+            regressions.append(key)
+            mark = " :warning:"
+        print(f"| {key} | {old:.3f} | {new:.3f} | {change:+.1%}{mark} |")
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0].strip())
+    parser.add_argument("--pages", type=int, default=50)
+    parser.add_argument("--diagrams", type=int, default=4, help="diagrams per page")
+    parser.add_argument("--size", type=int, default=10, help="edges per generated flowchart")
+    parser.add_argument("--format", choices=("raw", "svg", "png"), default="raw", help="mermaid_output_format")
+    parser.add_argument("--latency", type=float, default=0.05, help="simulated seconds per rendered diagram")
+    parser.add_argument("--zoom-every", type=int, default=4, help="give every Nth diagram the :zoom: option, 0 for none")
+    parser.add_argument("-j", "--jobs", type=int, default=0, help="Sphinx parallel jobs")
+    parser.add_argument("--keep", metavar="DIR", help="generate and build in DIR and keep it")
+    parser.add_argument("--repeat", type=int, default=1, help="build N times and report the fastest timings")
+    parser.add_argument("--json", action="store_true", help="print results as JSON")
+    parser.add_argument("--output", metavar="FILE", help="also write results as JSON to FILE")
+    parser.add_argument("--baseline", metavar="FILE", help="compare results with those saved in FILE by --output")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="fraction by which a metric may exceed the baseline (default: 0.25)")
+    args = parser.parse_args(argv)
+
+    baseline = None
+    if args.baseline:
+        baseline = json.loads(Path(args.baseline).read_text(encoding="utf-8"))
+
+    if args.repeat > 1:
+        # Sphinx registers nodes globally, each build gets a fresh process.
+        runs = []
+        for _ in range(args.repeat):
+            with ProcessPoolExecutor(1, mp_context=multiprocessing.get_context("spawn")) as executor:
+                runs.append(executor.submit(run, args).result())
+    else:
+        runs = [run(args)]
+    results = {**runs[-1], **{key: min(r[key] for r in runs) for key in TIMINGS}}
+    if args.output:
+        Path(args.output).write_text(json.dumps(results, indent=2) + "\n", encoding="utf-8")
+    if args.json:
+        print(json.dumps(results, indent=2))
+    elif baseline is None:
+        width = max(map(len, results))
+        for key, value in results.items():
+            if isinstance(value, float):
+                value = f"{value:.3f}"
+            print(f"{key:<{width}}  {value}")
+
+    if baseline is not None:
+        mismatched = [key for key in PARAMETERS if baseline.get(key) != results[key]]
+        if mismatched:
+            sys.exit(f"baseline {args.baseline} was run with different {', '.join(mismatched)}")
+        regressions = compare(results, baseline, args.tolerance)
+        if regressions:
+            sys.exit(f"{', '.join(regressions)} regressed by more than {args.tolerance:.0%} against {args.baseline}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,25 @@
+#!/usr/bin/env python3
+"""Stand-in for mermaid-cli used by the benchmarks.
+
+Sleeps for ``MMDC_STUB_LATENCY`` seconds (default 0.05) to simulate the
+renderer start-up and layout cost, then writes a placeholder output file.
+"""
+
+import os
+import sys
+import time
+
+args = sys.argv[1:]
+infn = args[args.index("-i") + 1]
+outfn = args[args.index("-o") + 1]
+
+time.sleep(float(os.environ.get("MMDC_STUB_LATENCY", "0.05")))
+
+with open(infn, encoding="utf-8") as src:
+    code = src.read()
+if outfn.endswith(".svg"):
+    with open(outfn, "w", encoding="utf-8") as out:
+        out.write(f'<svg xmlns="http://www.w3.org/2000/svg"><desc>{len(code)}</desc></svg>')
+else:
+    with open(outfn, "wb") as out:
+        out.write(b"\0" * 64)
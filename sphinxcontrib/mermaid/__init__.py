@@ -13,16 +13,16 @@ from __future__ import annotations
 
 import codecs
 import errno
+import html
 import os
 import posixpath
 import re
-import shlex
-import uuid
+import shutil
+import subprocess
 from hashlib import sha1
 from json import dumps, loads
 from pathlib import Path
 from subprocess import PIPE, Popen
-from tempfile import TemporaryDirectory
 from typing import ClassVar
 
 import sphinx
@@ -40,7 +40,26 @@ from sphinx.util.osutil import ensuredir
 from yaml import dump
 
 from .autoclassdiag import class_diagram
-from .exceptions import MermaidError
+from .exceptions import MermaidError, MermaidRendererCrashed, MermaidRenderTimeout
+from .icons import build_icon_subsets, page_icon_packs
+from .render import (
+    CircuitBreaker,
+    RenderQueue,
+    RenderResult,
+    auto_policy,
+    cached_output,
+    get_cache_dir,
+    manifest_job,
+    output_filename,
+    prerender_diagram,
+    render_diagram,
+    render_diagrams,
+    render_key,
+    render_to,
+    write_manifest,
+)
+from .renderers import close_renderers, kill_process_tree, render_timeout
+from .vendor import vendor_assets
 
 logger = logging.getLogger(__name__)
 
@@ -50,6 +69,12 @@ _FULLSCREEN_CSS = (_MODULE_DIR / "fullscreen.css.j2").read_text(encoding="utf-8"
 _MERMAID_CSS = (_MODULE_DIR / "default.css.j2").read_text(encoding="utf-8")
 _MERMAID_JS = (_MODULE_DIR / "default.js.j2").read_text(encoding="utf-8")
 
+# ``layout: elk`` (or ``elk.stress`` etc.) or ``flowchart: {defaultRenderer: elk}``
+# in front matter, ``%%{init}%%``, ``:config:``, ``mermaid_config`` or
+# ``mermaid_init_config``, and the ``flowchart-elk`` diagram type.
+_ELK_LAYOUT_RE = re.compile(r"""\b(layout|defaultRenderer)["']?\s*:\s*["']?elk\b""")
+_ELK_DIAGRAM_RE = re.compile(r"^\s*flowchart-elk\b", re.MULTILINE)
+
 mapname_re = re.compile(r'<map id="(.*?)"')
 
 
@@ -146,9 +171,11 @@ class Mermaid(Directive):
                 )
             ]
 
-        # Wrap the mermaid code into a code node.
+        # Wrap the mermaid code into a code node. The code itself is interned
+        # in the environment, see get_mermaid_code().
+        env = self.state.document.settings.env
         node = mermaid()
-        node["code"] = mmcode
+        node["code_key"] = intern_source(env, mmcode)
         node["options"] = {}
         # Sphinx directives
         if "alt" in self.options:
@@ -157,24 +184,21 @@ class Mermaid(Directive):
             node["align"] = self.options["align"]
         if "inline" in self.options:
             node["inline"] = True
+        # Derive the id from the page, the diagram's position and its code,
+        # so that rebuilding unchanged input yields byte-identical HTML.
+        position = env.new_serialno("mermaid")
         if "zoom" in self.options:
             node["zoom"] = True
-            node["zoom_id"] = f"id-{uuid.uuid4()}"
+            node["zoom_id"] = "id-" + sha1(f"{env.docname}\0{position}\0{node['code_key']}".encode()).hexdigest()[:16]
 
         # Mermaid directives
-        mm_config = "---"
         if "config" in self.options:
-            mm_config += "\n"
-            mm_config += dump({"config": loads(self.options["config"])})
-        elif self.state_machine.document.settings.env.config.mermaid_config is not None:
-            mm_config += "\n"
-            mm_config += dump({"config": self.state_machine.document.settings.env.config.mermaid_config})
+            node["config_key"] = intern_source(env, dump({"config": loads(self.options["config"])}))
+        elif env.config.mermaid_config is not None:
+            node["config_key"] = env.mermaid_config_key
         if "title" in self.options:
-            mm_config += "\n"
-            mm_config += f"title: {self.options['title']}"
-        mm_config += "\n---\n"
-        if mm_config != "---\n---\n":
-            node["code"] = mm_config + node["code"]
+            node["title"] = self.options["title"]
+        env.mermaid_diagrams.setdefault(env.docname, []).append((node["code_key"], node.get("config_key"), node.get("title")))
 
         caption = self.options.get("caption")
         if caption is not None:
@@ -206,57 +230,261 @@ class MermaidClassDiagram(Mermaid):
         )
 
 
-def render_mm(self, code, options, _fmt, prefix="mermaid"):
-    """Render mermaid code into a PNG or PDF output file."""
+def intern_source(env, text):
+    """Store ``text`` once in the environment and return its key."""
+    key = sha1(text.encode("utf-8")).hexdigest()
+    env.mermaid_sources.setdefault(key, text)
+    return key
 
-    if _fmt == "raw":
-        _fmt = "png"
 
-    mermaid_cmd = self.builder.config.mermaid_cmd
-    mermaid_cmd_shell = self.builder.config.mermaid_cmd_shell in {True, "True", "true"}
-    hashkey = (code + str(options) + str(self.builder.config.mermaid_sequence_config)).encode("utf-8")
+def assemble_code(sources, code_key, config_key=None, title=None):
+    """Build the full mermaid code from interned parts, front matter included."""
+    mm_config = "---"
+    if config_key is not None:
+        mm_config += "\n"
+        mm_config += sources[config_key]
+    if title is not None:
+        mm_config += "\n"
+        mm_config += f"title: {title}"
+    mm_config += "\n---\n"
+    if mm_config != "---\n---\n":
+        return mm_config + sources[code_key]
+    return sources[code_key]
 
-    basename = f"{prefix}-{sha1(hashkey).hexdigest()}"
-    fname = f"{basename}.{_fmt}"
-    relfn = posixpath.join(self.builder.imgpath, fname)
-    outdir = os.path.join(self.builder.outdir, self.builder.imagedir)
-    outfn = os.path.join(outdir, fname)
-    with TemporaryDirectory() as tempDir:
-        tmpfn = os.path.join(tempDir, basename)
 
-        if os.path.isfile(outfn):
-            return relfn, outfn
+def get_mermaid_code(env, node):
+    """Return the mermaid code of a ``mermaid`` node."""
+    if "code" in node:
+        # Nodes created by other extensions may carry their code directly.
+        return node["code"]
+    return assemble_code(env.mermaid_sources, node["code_key"], node.get("config_key"), node.get("title"))
 
-        ensuredir(os.path.dirname(outfn))
 
-        with open(tmpfn, "w", encoding="utf-8") as t:
-            t.write(code)
+def init_sources(app):
+    """Set up the diagram source store and intern ``mermaid_config`` once per build."""
+    env = app.builder.env
+    if not hasattr(env, "mermaid_sources"):
+        env.mermaid_sources = {}
+        env.mermaid_diagrams = {}
+        env.mermaid_render_keys = {}
+    env.mermaid_config_key = None
+    if app.config.mermaid_config is not None:
+        env.mermaid_config_key = intern_source(env, dump({"config": app.config.mermaid_config}))
 
-        if isinstance(mermaid_cmd, str):
-            mm_args = shlex.split(mermaid_cmd)
-        else:
-            mm_args = list(mermaid_cmd)
 
-        mm_args.extend(self.builder.config.mermaid_params)
-        mm_args += ["-i", tmpfn, "-o", outfn]
-        if self.builder.config.mermaid_sequence_config:
-            mm_args.extend(["--configFile", self.builder.config.mermaid_sequence_config])
+def purge_sources(app, env, docname):
+    env.mermaid_diagrams.pop(docname, None)
+    env.mermaid_render_keys.pop(docname, None)
 
-        try:
-            p = Popen(mm_args, shell=mermaid_cmd_shell, stdout=PIPE, stdin=PIPE, stderr=PIPE, text=True)
-        except FileNotFoundError:
-            logger.warning(f"command {mermaid_cmd!r} cannot be run (needed for mermaid output), check the mermaid_cmd setting")
-            return None, None
 
-        stdout, stderr = p.communicate(code)
-        if self.builder.config.mermaid_verbose:
-            logger.info(stdout)
+def merge_sources(app, env, docnames, other):
+    env.mermaid_sources.update(other.mermaid_sources)
+    for docname in docnames:
+        if docname in other.mermaid_diagrams:
+            env.mermaid_diagrams[docname] = other.mermaid_diagrams[docname]
+        if docname in other.mermaid_render_keys:
+            env.mermaid_render_keys[docname] = other.mermaid_render_keys[docname]
 
-        if p.returncode != 0:
-            raise MermaidError(f"Mermaid exited with error:\n[stderr]\n{stderr}\n[stdout]\n{stdout}")
-        if not os.path.isfile(outfn):
-            raise MermaidError(f"Mermaid did not produce an output file:\n[stderr]\n{stderr}\n[stdout]\n{stdout}")
-        return relfn, outfn
+
+def collect_render_keys(app, doctree):
+    """Record the render keys of a document's diagrams for :func:`prune_images`.
+
+    Connected to ``doctree-read`` late, so that diagrams other extensions add
+    to the doctree without the directive are included.
+    """
+    keys = {render_key(get_mermaid_code(app.env, node), node["options"], app.config) for node in doctree.findall(mermaid)}
+    if keys:
+        app.env.mermaid_render_keys[app.env.docname] = keys
+
+
+def prune_sources(app, env):
+    """Drop sources no longer referenced by any document."""
+    live = {env.mermaid_config_key}
+    for diagrams in env.mermaid_diagrams.values():
+        for code_key, config_key, _title in diagrams:
+            live.add(code_key)
+            live.add(config_key)
+    for key in env.mermaid_sources.keys() - live:
+        del env.mermaid_sources[key]
+
+
+def init_render_state(app):
+    """Give each build a fresh :class:`CircuitBreaker` and set of referenced images.
+
+    With ``mermaid_render_manifest``, diagrams missing from the cache are
+    spooled as one file per job below the doctree directory, which works
+    across parallel write processes, and collected by :func:`write_render_manifest`.
+    """
+    app.builder.mermaid_breaker = CircuitBreaker(app.config.mermaid_render_max_failures)
+    app.builder.mermaid_images = set()
+    app.builder.mermaid_manifest_spool = None
+    if app.config.mermaid_render_manifest:
+        spool = os.path.join(app.doctreedir, "mermaid-manifest")
+        shutil.rmtree(spool, ignore_errors=True)
+        app.builder.mermaid_manifest_spool = spool
+
+    app.builder.mermaid_render_queue = None
+    workers = app.config.mermaid_render_ahead
+    if workers and not app.config.mermaid_render_manifest:
+        if workers is True:
+            workers = os.cpu_count() or 1
+        app.builder.mermaid_render_queue = RenderQueue(workers, app.config, *_render_dirs(app.builder), app.builder.mermaid_breaker)
+
+
+def _render_dirs(builder):
+    """Return the output, cache and SVG directories of build-time rendering."""
+    outdir = os.path.join(builder.outdir, builder.imagedir)
+    cachedir = get_cache_dir(builder.config, builder.confdir)
+    # SVGs converted to other formats are kept next to the doctrees, which
+    # "sphinx-build -M" shares between builders, unless there is a cache.
+    svgdir = cachedir or os.path.join(builder.doctreedir, "mermaid")
+    return outdir, cachedir, svgdir
+
+
+def _ahead_format(app, docname, code):
+    """Return the format the writer will render a diagram in, or None."""
+    if app.builder.format == "latex":
+        return "pdf"
+    if app.builder.format == "texinfo":
+        return "png"
+    if app.builder.format != "html":
+        return None
+    fmt = app.config.mermaid_output_format
+    if fmt == "auto":
+        return auto_policy(app.config)["format"] if prerender_diagram(app.config, docname, code) else None
+    return fmt if fmt in ("png", "svg") else None
+
+
+def render_ahead(app, env, docnames):
+    """Queue the diagrams of freshly read documents with ``mermaid_render_ahead``.
+
+    Connected to ``doctree-read`` for documents read in the main process, and
+    to ``env-merge-info`` for those read by parallel workers: a forked worker
+    would take unfinished renders down with it when it exits.
+    """
+    queue = getattr(app.builder, "mermaid_render_queue", None)
+    if queue is None or queue.pid != os.getpid():
+        return
+    for docname in docnames:
+        for code_key, config_key, title in env.mermaid_diagrams.get(docname, ()):
+            code = assemble_code(env.mermaid_sources, code_key, config_key, title)
+            fmt = _ahead_format(app, docname, code)
+            if fmt is not None:
+                queue.submit(code, {}, fmt)
+
+
+def render_ahead_doctree(app, doctree):
+    render_ahead(app, app.env, [app.env.docname])
+
+
+def render_ahead_merged(app, env, docnames, other):
+    render_ahead(app, env, docnames)
+
+
+def drain_render_queue(app, env):
+    """Finish the queued renders before a parallel write forks its workers."""
+    queue = getattr(app.builder, "mermaid_render_queue", None)
+    if queue is not None and app.parallel > 1:
+        queue.drain()
+
+
+def finish_render_queue(app, exception):
+    """Wait for the queued renders; connected to ``build-finished``."""
+    queue = getattr(app.builder, "mermaid_render_queue", None)
+    if queue is not None and queue.pid == os.getpid():
+        queue.finish(cancel=exception is not None)
+
+
+def _spool_job(spool, job):
+    docname = job["docnames"][0] if job["docnames"] else ""
+    fname = f"{job['filename']}.{sha1(docname.encode('utf-8')).hexdigest()[:8]}.json"
+    ensuredir(spool)
+    with open(os.path.join(spool, fname), "w", encoding="utf-8") as fp:
+        fp.write(dumps(job))
+
+
+def _pending_file(app):
+    return os.path.join(app.doctreedir, f"mermaid-pending-{app.builder.name}.json")
+
+
+def write_render_manifest(app, exception):
+    """Write the diagrams the build did not find in the cache; connected to ``build-finished``.
+
+    The documents showing a fallback for them are remembered, so that the
+    next build rewrites them (see :func:`outdated_pending_docs`).
+    """
+    spool = getattr(app.builder, "mermaid_manifest_spool", None)
+    # Builders that do not render diagrams must not empty the manifest.
+    if exception is not None or app.builder.format not in ("html", "latex", "texinfo"):
+        return
+    if spool is None:
+        # Documents rewritten without a manifest rendered their diagrams.
+        if os.path.isfile(_pending_file(app)):
+            os.remove(_pending_file(app))
+        return
+    jobs = []
+    if os.path.isdir(spool):
+        for fname in sorted(os.listdir(spool)):
+            with open(os.path.join(spool, fname), encoding="utf-8") as fp:
+                jobs.append(loads(fp.read()))
+        shutil.rmtree(spool, ignore_errors=True)
+    with open(_pending_file(app), "w", encoding="utf-8") as fp:
+        fp.write(dumps(sorted({docname for job in jobs for docname in job["docnames"]})))
+    path = os.path.join(app.confdir, app.config.mermaid_render_manifest)
+    try:
+        count = write_manifest(path, jobs, app.config)
+    except MermaidError as exc:
+        logger.warning(str(exc))
+        return
+    logger.info(f"{count} mermaid diagrams missing from the cache written to render manifest {path}")
+
+
+def outdated_pending_docs(app, env, added, changed, removed):
+    """Rewrite documents written while their diagrams were missing from the cache.
+
+    Connected to ``env-get-outdated``: once the manifest has been rendered,
+    an incremental build picks up the diagrams instead of keeping the fallback.
+    """
+    try:
+        with open(_pending_file(app), encoding="utf-8") as fp:
+            pending = loads(fp.read())
+    except (OSError, ValueError):
+        return []
+    return [docname for docname in pending if docname in env.found_docs and docname not in removed]
+
+
+def render_mm(self, code, options, _fmt, prefix="mermaid"):
+    """Render mermaid code into a PNG or PDF output file."""
+
+    if _fmt == "raw":
+        _fmt = "png"
+
+    config = self.builder.config
+    fname = output_filename(code, options, config, _fmt, prefix)
+    relfn = posixpath.join(self.builder.imgpath, fname)
+    outdir, cachedir, svgdir = _render_dirs(self.builder)
+    spool = getattr(self.builder, "mermaid_manifest_spool", None)
+    queue = getattr(self.builder, "mermaid_render_queue", None)
+    if spool is not None:
+        # Only resolve cache hits, the rest is rendered from the manifest.
+        outfn = cached_output(fname, outdir, cachedir)
+        if outfn is None:
+            _spool_job(spool, manifest_job(code, options, _fmt, config, prefix, getattr(self.builder, "current_docname", None)))
+            return None, None
+    elif queue is not None and fname in queue:
+        # Rendered in the background since the document was read.
+        outfn = queue.result(fname)
+        if outfn is None:
+            return None, None
+    else:
+        breaker = getattr(self.builder, "mermaid_breaker", None)
+        outfn = render_to(code, options, _fmt, outdir, config, cachedir, prefix, breaker, svgdir)
+        if outfn is None:
+            return None, None
+    referenced = getattr(self.builder, "mermaid_images", None)
+    if referenced is not None:
+        referenced.add(fname)
+    return relfn, outfn
 
 
 def _render_mm_html_raw(self, node, code, options, prefix="mermaid", imgcls=None, alt=None):
@@ -286,17 +514,32 @@ def render_mm_html(self, node, code, options, prefix="mermaid", imgcls=None, alt
     if _fmt == "raw":
         return _render_mm_html_raw(self, node, code, options, prefix="mermaid", imgcls=None, alt=None)
 
+    _auto = _fmt == "auto"
+    if _auto:
+        if not prerender_diagram(self.builder.config, self.builder.current_docname, code):
+            node["client_side"] = True
+            return _render_mm_html_raw(self, node, code, options, prefix=prefix, imgcls=imgcls, alt=alt)
+        _fmt = auto_policy(self.builder.config)["format"]
+
     try:
         if _fmt not in ("png", "svg"):
-            raise MermaidError(f"mermaid_output_format must be one of 'raw', 'png', 'svg', but is {_fmt!r}")
+            raise MermaidError(f"mermaid_output_format must be one of 'raw', 'auto', 'png', 'svg', but is {_fmt!r}")
 
         fname, _outfn = render_mm(self, code, options, _fmt, prefix)
     except MermaidError as exc:
         logger.warning(f"mermaid code {code!r}: " + str(exc))
-        raise nodes.SkipNode
+        # In auto mode the browser renders what the build could not, and
+        # reports syntax errors in place.
+        if not _auto and not isinstance(exc, (MermaidRenderTimeout, MermaidRendererCrashed)):
+            raise nodes.SkipNode
+        fname = None
 
     if fname is None:
-        self.body.append(self.encode(code))
+        if _auto or self.builder.config.mermaid_render_fallback == "raw":
+            # Rendered in the browser instead, install_js loads mermaid for it.
+            node["client_side"] = True
+            return _render_mm_html_raw(self, node, code, options, prefix=prefix, imgcls=imgcls, alt=alt)
+        self.body.append(f'<pre class="mermaid-placeholder">{self.encode(code)}</pre>\n')
     else:
         if alt is None:
             alt = node.get("alt", self.encode(code).strip())
@@ -318,7 +561,7 @@ def render_mm_html(self, node, code, options, prefix="mermaid", imgcls=None, alt
 
 
 def html_visit_mermaid(self, node):
-    render_mm_html(self, node, node["code"], node["options"], imgcls="mermaid")
+    render_mm_html(self, node, get_mermaid_code(self.builder.env, node), node["options"], imgcls="mermaid")
 
 
 def render_mm_latex(self, node, code, options, prefix="mermaid"):
@@ -328,17 +571,27 @@ def render_mm_latex(self, node, code, options, prefix="mermaid"):
         logger.warning(f"mm code {code!r}: " + str(exc))
         raise nodes.SkipNode
 
-    if self.builder.config.mermaid_pdfcrop != "":
+    if fname is not None and self.builder.config.mermaid_pdfcrop != "":
         mm_args = [self.builder.config.mermaid_pdfcrop, outfn]
         try:
-            p = Popen(mm_args, stdout=PIPE, stdin=PIPE, stderr=PIPE)
+            # In its own process group, so that a timeout can kill what it started.
+            group = {"creationflags": subprocess.CREATE_NEW_PROCESS_GROUP} if os.name == "nt" else {"start_new_session": True}
+            p = Popen(mm_args, stdout=PIPE, stdin=PIPE, stderr=PIPE, **group)
         except OSError as err:
             if err.errno != errno.ENOENT:  # No such file or directory
                 raise
             logger.warning(f"command {self.builder.config.mermaid_pdfcrop!r} cannot be run (needed to crop pdf), check the mermaid_cmd setting")
             return None, None
 
-        stdout, stderr = p.communicate()
+        timeout = render_timeout(self.builder.config)
+        try:
+            stdout, stderr = p.communicate(timeout=timeout)
+        except subprocess.TimeoutExpired:
+            kill_process_tree(p)
+            raise MermaidRenderTimeout(f"PdfCrop did not finish within {timeout} seconds and was killed")
+        except BaseException:
+            kill_process_tree(p)
+            raise
         if self.builder.config.mermaid_verbose:
             logger.info(stdout)
 
@@ -372,7 +625,7 @@ def render_mm_latex(self, node, code, options, prefix="mermaid"):
 
 
 def latex_visit_mermaid(self, node):
-    render_mm_latex(self, node, node["code"], node["options"])
+    render_mm_latex(self, node, get_mermaid_code(self.builder.env, node), node["options"])
 
 
 def render_mm_texinfo(self, node, code, options, prefix="mermaid"):
@@ -387,7 +640,7 @@ def render_mm_texinfo(self, node, code, options, prefix="mermaid"):
 
 
 def texinfo_visit_mermaid(self, node):
-    render_mm_texinfo(self, node, node["code"], node["options"])
+    render_mm_texinfo(self, node, get_mermaid_code(self.builder.env, node), node["options"])
 
 
 def text_visit_mermaid(self, node):
@@ -406,6 +659,64 @@ def man_visit_mermaid(self, node):
     raise nodes.SkipNode
 
 
+_IMAGE_RE = re.compile(r"mermaid-([0-9a-f]{40})(?:-crop)?\.(?:png|svg|pdf)")
+
+
+def prune_images(app, exception):
+    """Remove rendered diagrams no document uses anymore; connected to ``build-finished``.
+
+    The images still in use are the render keys recorded in the environment
+    for every document when it was read (see :func:`collect_render_keys`), so
+    documents that were not rewritten by an incremental build keep theirs.
+    SVGs kept next to the doctrees for ``mermaid_svg_convert`` are pruned too.
+    """
+    mode = app.config.mermaid_prune_images
+    if not mode or exception is not None:
+        return
+    imagedir = os.path.join(app.outdir, getattr(app.builder, "imagedir", ""))
+    dirs = [imagedir]
+    if get_cache_dir(app.config, app.confdir) is None:
+        dirs.append(os.path.join(app.doctreedir, "mermaid"))
+
+    # Images rendered during this build cover nodes that other extensions add
+    # after reading.
+    live = {match.group(1) for match in map(_IMAGE_RE.fullmatch, getattr(app.builder, "mermaid_images", ())) if match}
+    for keys in app.env.mermaid_render_keys.values():
+        live.update(keys)
+
+    orphans = []
+    for dirname in dirs:
+        if not os.path.isdir(dirname):
+            continue
+        for fname in sorted(os.listdir(dirname)):
+            match = _IMAGE_RE.fullmatch(fname)
+            if match and match.group(1) not in live:
+                orphans.append(os.path.join(dirname, fname))
+    if not orphans:
+        return
+
+    size = sum(os.path.getsize(path) for path in orphans)
+    if mode == "dry-run":
+        for path in orphans:
+            logger.info(f"would remove orphaned mermaid image {os.path.relpath(path, app.outdir)}")
+        logger.info(f"{len(orphans)} orphaned mermaid images ({size // 1024} KiB) would be removed")
+        return
+    for path in orphans:
+        os.remove(path)
+    logger.info(f"removed {len(orphans)} orphaned mermaid images ({size // 1024} KiB)")
+
+
+def _page_uses_elk(app: Sphinx, doctree: nodes.document | None) -> bool:
+    """Return whether a diagram of the page may need the ELK layout plugin."""
+    if doctree is None or _ELK_LAYOUT_RE.search(dumps(app.config.mermaid_init_config)):
+        return True
+    for node in doctree.findall(mermaid):
+        code = get_mermaid_code(app.env, node)
+        if _ELK_LAYOUT_RE.search(code) or _ELK_DIAGRAM_RE.search(code):
+            return True
+    return False
+
+
 def _resolve_local_url(url: str, context: dict) -> str:
     """Resolve a *_use_local config value to a URL.
 
@@ -432,17 +743,27 @@ def install_js(
     context: dict,
     doctree: nodes.document | None,
 ) -> None:
-    # Build-time PNG and SVG output does not need client-side rendering.
-    if app.config.mermaid_output_format != "raw":
+    # Build-time PNG and SVG output does not need client-side rendering,
+    # except for diagrams that fell back to raw output or that "auto" left
+    # to the browser.
+    # The translators mark diagrams left to the browser in the other formats.
+    _client_side = doctree is not None and any(node.get("client_side") for node in doctree.findall(mermaid))
+    if app.config.mermaid_output_format != "raw" and not _client_side:
         return
 
     # Skip for pages without Mermaid diagrams
     if doctree and not doctree.next_node(mermaid):
         return
 
+    _vendored = getattr(app.env, "mermaid_vendored_assets", {})
+    _preload_urls = []
+
     # Add required JavaScript
     if app.config.mermaid_use_local:
         _mermaid_js_url = _resolve_local_url(app.config.mermaid_use_local, context)
+    elif "mermaid" in _vendored:
+        _mermaid_js_url = _resolve_local_url(_vendored["mermaid"], context)
+        _preload_urls.append(_mermaid_js_url)
     elif app.config.mermaid_version == "latest":
         _mermaid_js_url = "https://cdn.jsdelivr.net/npm/mermaid/dist/mermaid.esm.min.mjs"
     elif Version(app.config.mermaid_version) > Version("10.2.0"):
@@ -451,9 +772,12 @@ def install_js(
         raise MermaidError("Requires mermaid js version 10.3.0 or later")
 
     _mermaid_elk_js_url = None
-    if app.config.mermaid_include_elk:
+    if app.config.mermaid_include_elk and _page_uses_elk(app, doctree):
         if app.config.mermaid_elk_use_local:
             _mermaid_elk_js_url = _resolve_local_url(app.config.mermaid_elk_use_local, context)
+        elif "elk" in _vendored:
+            _mermaid_elk_js_url = _resolve_local_url(_vendored["elk"], context)
+            _preload_urls.append(_mermaid_elk_js_url)
         elif app.config.mermaid_elk_version == "latest":
             _mermaid_elk_js_url = "https://cdn.jsdelivr.net/npm/@mermaid-js/layout-elk/dist/mermaid-layout-elk.esm.min.mjs"
         elif app.config.mermaid_elk_version:
@@ -465,6 +789,8 @@ def install_js(
     if app.config.mermaid_include_zenuml:
         if app.config.mermaid_zenuml_use_local:
             _mermaid_zenuml_js_url = _resolve_local_url(app.config.mermaid_zenuml_use_local, context)
+        elif "zenuml" in _vendored:
+            _mermaid_zenuml_js_url = _resolve_local_url(_vendored["zenuml"], context)
         elif app.config.mermaid_zenuml_version == "latest":
             _mermaid_zenuml_js_url = "https://cdn.jsdelivr.net/npm/@mermaid-js/mermaid-zenuml/dist/mermaid-zenuml.esm.min.mjs"
         elif app.config.mermaid_zenuml_version:
@@ -472,7 +798,19 @@ def install_js(
                 f"https://cdn.jsdelivr.net/npm/@mermaid-js/mermaid-zenuml@{app.config.mermaid_zenuml_version}/dist/mermaid-zenuml.esm.min.mjs"
             )
 
-    _mermaid_icon_packs = {name: _resolve_local_url(url, context) for name, url in app.config.mermaid_icon_packs.items()}
+    # Vendored modules are same-origin, let the browser fetch them in parallel
+    # with the page instead of discovering them when the module script runs.
+    if _preload_urls:
+        context["metatags"] = context.get("metatags", "") + "".join(
+            f'\n<link rel="modulepreload" href="{html.escape(url)}">' for url in _preload_urls
+        )
+
+    _mermaid_icon_packs = app.config.mermaid_icon_packs
+    if app.config.mermaid_icon_subset and doctree:
+        _subsets = getattr(app.env, "mermaid_icon_subsets", {})
+        _used_packs = page_icon_packs(app, (get_mermaid_code(app.env, node) for node in doctree.findall(mermaid)))
+        _mermaid_icon_packs = {name: _subsets.get(name, url) for name, url in _mermaid_icon_packs.items() if name in _used_packs}
+    _mermaid_icon_packs = {name: _resolve_local_url(url, context) for name, url in _mermaid_icon_packs.items()}
 
     _wrote_mermaid_run = False
     _d3_selector = ""
@@ -521,11 +859,15 @@ def install_js(
         "button_opacity": _dump_js(f"{_button_opacity}%"),  # ignored
         "add_fullscreen": _dump_js(_has_fullscreen),
         "add_zoom": _dump_js(_has_zoom),
+        "mermaid_perf": app.config.mermaid_perf,
+        "mermaid_perf_event": app.config.mermaid_perf_event and _dump_js(app.config.mermaid_perf_event),
     }
 
     if _has_zoom:
         if app.config.d3_use_local:
             _d3_js_url = app.config.d3_use_local
+        elif "d3" in _vendored:
+            _d3_js_url = _vendored["d3"]
         elif app.config.d3_version == "latest":
             _d3_js_url = "https://cdn.jsdelivr.net/npm/d3/dist/d3.min.js"
         elif app.config.d3_version:
@@ -544,6 +886,7 @@ def install_js(
             ),
             d3_selector=_dump_js(_d3_selector),
             d3_node_count=_d3_node_count,
+            tile_threshold=app.config.mermaid_zoom_tile_threshold,
             **common_render_args,
         )
         app.add_js_file(None, body=_mermaid_js_script, priority=app.config.mermaid_js_priority, type="module")
@@ -556,6 +899,7 @@ def install_js(
                 fullscreen_css=_dump_js(""),
                 d3_selector=_dump_js(""),  # ignored
                 d3_node_count=-1,  # ignored
+                tile_threshold=0,  # ignored
                 **common_render_args,
             ),
             priority=app.config.mermaid_js_priority,
@@ -575,20 +919,38 @@ def setup(app):
     app.add_directive("mermaid", Mermaid)
     app.add_directive("autoclasstree", MermaidClassDiagram)
 
-    app.add_config_value("mermaid_cmd", "mmdc", "html")
+    app.add_config_value("mermaid_cmd", "mmdc", "html", types=(str, list, tuple))
     app.add_config_value("mermaid_cmd_shell", "False", "html")
     app.add_config_value("mermaid_pdfcrop", "", "html")
     app.add_config_value("mermaid_output_format", "raw", "html")
+    app.add_config_value("mermaid_auto_policy", {}, "html")
     app.add_config_value("mermaid_params", [], "html")
     app.add_config_value("mermaid_verbose", False, "html")
     app.add_config_value("mermaid_sequence_config", None, "html")
     app.add_config_value("mermaid_config", None, "env")
+    app.add_config_value("mermaid_cache_dir", None, "")
+    # None stands for "mmdc": values of any type are accepted (names, callables
+    # and Renderer classes or instances), which Sphinx only allows without a default.
+    app.add_config_value("mermaid_renderer", None, "")
+    app.add_config_value("mermaid_renderer_url", "http://localhost:8000/mermaid/{format}", "")
+    app.add_config_value("mermaid_daemon_cmd", None, "")
+    app.add_config_value("mermaid_daemon_idle_timeout", 600, "")
+    app.add_config_value("mermaid_daemon_state_file", None, "")
+    app.add_config_value("mermaid_render_timeout", 120, "", types=(int, float, type(None)))
+    app.add_config_value("mermaid_render_retries", 0, "")
+    app.add_config_value("mermaid_render_max_failures", 5, "")
+    app.add_config_value("mermaid_render_fallback", "raw", "html")
+    app.add_config_value("mermaid_svg_convert", False, "")
+    app.add_config_value("mermaid_prune_images", False, "", types=(bool, str))
+    app.add_config_value("mermaid_render_manifest", None, "")
+    app.add_config_value("mermaid_render_ahead", False, "", types=(bool, int))
 
     app.add_config_value("mermaid_init_config", {"startOnLoad": False}, "html")
     app.add_config_value("mermaid_dark_theme", "dark", "html")
     app.add_config_value("mermaid_light_theme", "default", "html")
     app.add_config_value("mermaid_version", "11.12.1", "html")
     app.add_config_value("mermaid_use_local", "", "html")
+    app.add_config_value("mermaid_vendor_assets", None, "html")
 
     # Plugins
     app.add_config_value("mermaid_include_elk", False, "html")
@@ -598,10 +960,12 @@ def setup(app):
     app.add_config_value("mermaid_elk_use_local", "", "html")
     app.add_config_value("mermaid_zenuml_use_local", "", "html")
     app.add_config_value("mermaid_icon_packs", {}, "html")
+    app.add_config_value("mermaid_icon_subset", False, "html")
 
     app.add_config_value("d3_use_local", "", "html")
     app.add_config_value("d3_version", "7.9.0", "html")
     app.add_config_value("mermaid_d3_zoom", False, "html")
+    app.add_config_value("mermaid_zoom_tile_threshold", 0, "html", types=(int,))
 
     app.add_config_value("mermaid_js_priority", 500, "html")
     app.add_config_value("mermaid_width", "100%", "html")
@@ -609,7 +973,25 @@ def setup(app):
     app.add_config_value("mermaid_fullscreen", True, "html")
     app.add_config_value("mermaid_fullscreen_button", "⛶", "html")
     app.add_config_value("mermaid_fullscreen_button_opacity", "50", "html")
-
+    app.add_config_value("mermaid_perf", False, "html")
+    app.add_config_value("mermaid_perf_event", "mermaid:perf", "html", types=(str, type(None)))
+
+    app.connect("builder-inited", init_sources)
+    app.connect("builder-inited", vendor_assets)
+    app.connect("builder-inited", init_render_state)
+    app.connect("env-get-outdated", outdated_pending_docs)
+    app.connect("env-purge-doc", purge_sources)
+    app.connect("doctree-read", render_ahead_doctree)
+    app.connect("doctree-read", collect_render_keys, priority=900)
+    app.connect("env-merge-info", merge_sources)
+    app.connect("env-merge-info", render_ahead_merged)
+    app.connect("env-updated", prune_sources)
+    app.connect("env-updated", build_icon_subsets)
+    app.connect("env-updated", drain_render_queue)
     app.connect("html-page-context", install_js)
+    app.connect("build-finished", finish_render_queue)
+    app.connect("build-finished", close_renderers)
+    app.connect("build-finished", prune_images)
+    app.connect("build-finished", write_render_manifest)
 
-    return {"version": sphinx.__display_version__, "parallel_read_safe": True}
+    return {"version": sphinx.__display_version__, "env_version": 2, "parallel_read_safe": True}
@@ -0,0 +1,231 @@
+"""
+Command line tool to prerender mermaid diagrams outside a Sphinx build.
+
+``sphinx-mermaid`` reads a Sphinx project, collects every ``mermaid`` and
+``autoclasstree`` diagram (reStructuredText, MyST and external ``.mmd`` files
+alike) and renders those that are not cached yet. A later ``sphinx-build`` run
+using the same ``mermaid_cache_dir`` then only sees cache hits.
+
+To spread rendering over several machines, ``--manifest`` writes the pending
+diagrams to a render manifest instead, and ``--from-manifest`` with
+``--shard i/N`` renders one part of it without reading the project.
+"""
+
+from __future__ import annotations
+
+import argparse
+import json
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from tempfile import TemporaryDirectory
+
+from sphinx.application import Sphinx
+
+from . import get_mermaid_code, mermaid
+from .exceptions import MermaidError
+from .render import (
+    CircuitBreaker,
+    auto_policy,
+    get_cache_dir,
+    manifest_job,
+    output_filename,
+    prerender_diagram,
+    read_manifest,
+    render_to,
+    shard_jobs,
+    write_manifest,
+)
+from .renderers import close_renderers
+
+
+def collect_diagrams(srcdir, confdir=None, confoverrides=None, parallel=0, status=None, warning=sys.stderr):
+    """Read a Sphinx project and return its config and its diagrams.
+
+    Diagrams are returned as ``(docname, code, options)`` tuples, with ``code``
+    exactly as the build renders it, so cache keys match.
+    """
+    # Reading is not a build: it must not write over the project's render manifest.
+    confoverrides = {**(confoverrides or {}), "mermaid_render_manifest": None}
+    with TemporaryDirectory() as tmpdir:
+        app = Sphinx(
+            srcdir,
+            confdir or srcdir,
+            os.path.join(tmpdir, "out"),
+            os.path.join(tmpdir, "doctrees"),
+            "dummy",
+            confoverrides=confoverrides,
+            status=status,
+            warning=warning,
+            freshenv=True,
+            parallel=parallel,
+        )
+        app.build(force_all=True)
+        diagrams = []
+        for docname in sorted(app.env.found_docs):
+            for node in app.env.get_doctree(docname).findall(mermaid):
+                diagrams.append((docname, get_mermaid_code(app.env, node), node["options"]))
+        return app.config, diagrams
+
+
+def _parse_defines(defines):
+    overrides = {}
+    for define in defines:
+        name, sep, value = define.partition("=")
+        if not sep:
+            raise SystemExit(f"sphinx-mermaid: -D option argument must be in the form name=value, got {define!r}")
+        overrides[name] = value
+    return overrides
+
+
+def _parse_shard(value):
+    index, sep, count = value.partition("/")
+    try:
+        index, count = int(index), int(count)
+    except ValueError:
+        index = count = 0
+    if not sep or not 1 <= index <= count:
+        raise argparse.ArgumentTypeError(f"expected a shard like 2/8, got {value!r}")
+    return index, count
+
+
+def _override_manifest_config(config, overrides):
+    # Values given with -D are strings; accept JSON for numbers, booleans and lists.
+    for name, value in overrides.items():
+        try:
+            value = json.loads(value)
+        except ValueError:
+            pass
+        setattr(config, name, value)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="sphinx-mermaid",
+        description="Prerender the mermaid diagrams of a Sphinx project into the diagram cache.",
+    )
+    parser.add_argument("sourcedir", nargs="?", help="path to the documentation source files")
+    parser.add_argument("-c", "--conf-dir", dest="confdir", help="directory containing conf.py (default: SOURCEDIR)")
+    parser.add_argument(
+        "-f",
+        "--format",
+        dest="formats",
+        action="append",
+        choices=("png", "svg", "pdf"),
+        help="output format to render, may be repeated (default: mermaid_output_format)",
+    )
+    parser.add_argument("--cache-dir", help="directory to render into (default: mermaid_cache_dir)")
+    parser.add_argument("-o", "--output-dir", help="also place rendered files here, e.g. _build/html/_images")
+    parser.add_argument("-j", "--jobs", type=int, default=os.cpu_count() or 1, help="number of diagrams rendered in parallel")
+    parser.add_argument("--check", action="store_true", help="only report diagrams whose rendered file is missing, exit with 1 if there are any")
+    parser.add_argument("--manifest", metavar="FILE", help="write the pending diagrams to a render manifest instead of rendering them")
+    parser.add_argument("--from-manifest", metavar="FILE", help="render the diagrams of a render manifest instead of reading SOURCEDIR")
+    parser.add_argument("--shard", type=_parse_shard, metavar="I/N", help="only handle the I-th of N equal parts of the diagrams")
+    parser.add_argument("-D", dest="define", action="append", default=[], metavar="setting=value", help="override a setting in conf.py")
+    parser.add_argument("-q", "--quiet", action="store_true", help="only print errors")
+    args = parser.parse_args(argv)
+
+    if args.from_manifest:
+        if args.sourcedir or args.manifest or args.formats:
+            parser.error("--from-manifest cannot be combined with SOURCEDIR, --manifest or --format")
+        try:
+            config, manifest = read_manifest(args.from_manifest)
+        except MermaidError as exc:
+            parser.error(str(exc))
+        _override_manifest_config(config, _parse_defines(args.define))
+        cachedir = None
+        jobs = {job["filename"]: (", ".join(job["docnames"]) or "-", job["code"], job["options"], job["format"], job["prefix"]) for job in manifest}
+    else:
+        if not args.sourcedir:
+            parser.error("SOURCEDIR is required unless --from-manifest is given")
+        confdir = os.path.abspath(args.confdir or args.sourcedir)
+        config, diagrams = collect_diagrams(
+            os.path.abspath(args.sourcedir),
+            confdir,
+            _parse_defines(args.define),
+            parallel=args.jobs,
+        )
+
+        formats = args.formats
+        if not formats:
+            if config.mermaid_output_format == "auto":
+                # Only what the build would prerender.
+                formats = [auto_policy(config)["format"]]
+                diagrams = [diagram for diagram in diagrams if prerender_diagram(config, diagram[0], diagram[1])]
+            elif config.mermaid_output_format not in ("png", "svg"):
+                parser.error("mermaid_output_format is not 'png', 'svg' or 'auto', use --format to choose what to render")
+            else:
+                formats = [config.mermaid_output_format]
+
+        cachedir = get_cache_dir(config, confdir)
+        jobs = {}
+        for docname, code, options in diagrams:
+            for fmt in formats:
+                fname = output_filename(code, options, config, fmt)
+                jobs.setdefault(fname, (docname, code, options, fmt, "mermaid"))
+
+    cachedir = os.path.abspath(args.cache_dir) if args.cache_dir else cachedir
+    outputdir = os.path.abspath(args.output_dir) if args.output_dir else None
+    if not cachedir and not outputdir and not args.manifest:
+        parser.error("no destination, set mermaid_cache_dir or pass --cache-dir or --output-dir")
+
+    def is_fresh(fname):
+        destinations = [d for d in (cachedir, outputdir) if d]
+        return bool(destinations) and all(os.path.isfile(os.path.join(d, fname)) for d in destinations)
+
+    if args.shard:
+        # Shards are cut from all jobs, not from those pending on this machine,
+        # so every machine agrees on them.
+        jobs = shard_jobs(jobs, *args.shard)
+    pending = {fname: job for fname, job in jobs.items() if not is_fresh(fname)}
+
+    if args.manifest:
+        manifest = [manifest_job(code, options, fmt, config, prefix, docname) for docname, code, options, fmt, prefix in pending.values()]
+        try:
+            write_manifest(args.manifest, manifest, config)
+        except MermaidError as exc:
+            parser.error(str(exc))
+        if not args.quiet:
+            print(f"wrote {len(pending)} of {len(jobs)} diagrams to {args.manifest}")
+        return 0
+
+    if args.check:
+        for fname, (docname, *_) in sorted(pending.items()):
+            print(f"{docname}: {fname} is missing")
+        if not args.quiet:
+            print(f"{len(jobs) - len(pending)} of {len(jobs)} diagrams up to date")
+        return 1 if pending else 0
+
+    breaker = CircuitBreaker(config.mermaid_render_max_failures)
+
+    def render(item):
+        fname, (docname, code, options, fmt, prefix) = item
+        try:
+            outfn = render_to(code, options, fmt, cachedir or outputdir, config, prefix=prefix, breaker=breaker)
+            if outfn is not None and cachedir and outputdir:
+                outfn = render_to(code, options, fmt, outputdir, config, cachedir, prefix)
+        except MermaidError as exc:
+            return f"{docname}: {fname}: {exc}"
+        if outfn is None:
+            if breaker.open:
+                return f"{docname}: {fname}: skipped after {breaker.failures} consecutive renderer failures"
+            return f"{docname}: {fname}: the mermaid renderer is unavailable"
+        if not args.quiet:
+            print(f"{docname}: rendered {fname}")
+        return None
+
+    try:
+        with ThreadPoolExecutor(max_workers=max(args.jobs, 1)) as executor:
+            errors = [error for error in executor.map(render, sorted(pending.items())) if error]
+    finally:
+        close_renderers()
+
+    for error in errors:
+        print(error, file=sys.stderr)
+    if not args.quiet:
+        print(f"rendered {len(pending) - len(errors)} of {len(pending)} pending diagrams ({len(jobs)} total)")
+    return 1 if errors else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -3,3 +3,15 @@ from sphinx.errors import SphinxError
 
 class MermaidError(SphinxError):
     category = "Mermaid error"
+
+
+class MermaidRendererUnavailable(MermaidError):
+    """The renderer backend cannot be run or reached at all."""
+
+
+class MermaidRenderTimeout(MermaidError):
+    """Rendering a diagram took longer than ``mermaid_render_timeout``."""
+
+
+class MermaidRendererCrashed(MermaidError):
+    """The renderer failed for a reason unrelated to the diagram, e.g. a browser crash."""
@@ -0,0 +1,150 @@
+"""
+Prune ``mermaid_icon_packs`` to the icons the documentation references.
+
+Iconify packs ship every icon of a collection, often several megabytes of
+JSON. With ``mermaid_icon_subset`` enabled, the diagram sources are scanned for
+``pack:icon`` references after reading, and each pack is replaced by a subset
+written to ``_static/_mermaid/icons/<pack>-<hash>.json``. Pages only register
+the packs their own diagrams use.
+"""
+
+from __future__ import annotations
+
+import json
+import os
+import re
+import urllib.request
+from hashlib import sha1
+
+from sphinx.util import logging
+from sphinx.util.osutil import ensuredir
+
+from .render import get_cache_dir
+
+logger = logging.getLogger(__name__)
+
+#: Iconify metadata that mermaid does not need to draw an icon.
+_METADATA_KEYS = ("categories", "chars", "prefixes", "suffixes")
+
+
+def icon_pattern(packs):
+    """Return a regex matching ``pack:icon`` references to the given packs."""
+    names = "|".join(re.escape(name) for name in sorted(packs, key=len, reverse=True))
+    return re.compile(rf"(?<![\w:-])({names}):([\w-]+)")
+
+
+def find_icons(pattern, code):
+    """Return the ``(pack, icon)`` pairs referenced in a diagram source."""
+    return set(pattern.findall(code))
+
+
+def subset_icon_pack(data, names):
+    """Return an Iconify pack reduced to ``names`` and the names it lacks.
+
+    Aliases are kept together with the icons they point to.
+    """
+    icons = data.get("icons", {})
+    aliases = data.get("aliases", {})
+    subset = {key: value for key, value in data.items() if key not in ("icons", "aliases", *_METADATA_KEYS)}
+    subset["icons"] = {}
+    subset_aliases = {}
+    missing = set()
+    for name in sorted(names):
+        target = name
+        while target in aliases and target not in subset_aliases:
+            subset_aliases[target] = aliases[target]
+            target = aliases[target].get("parent")
+        if target in icons:
+            subset["icons"][target] = icons[target]
+        elif target not in subset_aliases:
+            missing.add(name)
+    if subset_aliases:
+        subset["aliases"] = subset_aliases
+    return subset, missing
+
+
+def _fetch(url, cachedir):
+    cachefn = os.path.join(cachedir, f"icons-{sha1(url.encode('utf-8')).hexdigest()}.json")
+    if os.path.isfile(cachefn):
+        with open(cachefn, "rb") as fp:
+            return fp.read()
+    with urllib.request.urlopen(url, timeout=30) as response:
+        content = response.read()
+    ensuredir(cachedir)
+    with open(cachefn, "wb") as fp:
+        fp.write(content)
+    return content
+
+
+def load_icon_pack(app, url):
+    """Return the parsed JSON of an icon pack, or None if it cannot be read.
+
+    Relative paths are looked up in ``html_static_path`` like the browser
+    would find them; remote packs are downloaded once and kept in
+    ``mermaid_cache_dir``, or next to the doctrees when it is not set.
+    """
+    if url.startswith("//"):
+        url = "https:" + url
+    try:
+        if url.startswith(("http://", "https://")):
+            content = _fetch(url, get_cache_dir(app.config, app.confdir) or os.path.join(app.doctreedir, "mermaid-icons"))
+        elif url.startswith("/"):
+            return None
+        else:
+            for staticdir in app.config.html_static_path:
+                path = os.path.join(app.confdir, staticdir, url)
+                if os.path.isfile(path):
+                    break
+            else:
+                return None
+            with open(path, "rb") as fp:
+                content = fp.read()
+        return json.loads(content)
+    except (OSError, ValueError):
+        return None
+
+
+def page_icon_packs(app, codes):
+    """Return the names of the configured packs referenced in ``codes``."""
+    packs = app.config.mermaid_icon_packs
+    if not packs:
+        return set()
+    pattern = icon_pattern(packs)
+    return {pack for code in codes for pack, _icon in find_icons(pattern, code)}
+
+
+def build_icon_subsets(app, env):
+    """Write the icon subsets; connected to ``env-updated``.
+
+    The static paths of the subsets are stored in ``env.mermaid_icon_subsets``
+    for :func:`install_js`. Packs that cannot be loaded keep their full URL.
+    """
+    env.mermaid_icon_subsets = {}
+    packs = app.config.mermaid_icon_packs
+    if not app.config.mermaid_icon_subset or not packs or app.builder.format != "html":
+        return
+
+    pattern = icon_pattern(packs)
+    used = {}
+    for diagrams in env.mermaid_diagrams.values():
+        for code_key, _config_key, _title in diagrams:
+            for pack, icon in find_icons(pattern, env.mermaid_sources[code_key]):
+                used.setdefault(pack, set()).add(icon)
+
+    outdir = os.path.join(app.outdir, "_static", "_mermaid", "icons")
+    for pack, names in sorted(used.items()):
+        data = load_icon_pack(app, packs[pack])
+        if data is None:
+            logger.warning(f"could not load icon pack {pack!r} from {packs[pack]!r}, the whole pack is loaded instead")
+            continue
+        subset, missing = subset_icon_pack(data, names)
+        for name in sorted(missing):
+            logger.warning(f"icon {pack}:{name} is not in icon pack {pack!r}")
+        content = json.dumps(subset, sort_keys=True, separators=(",", ":")).encode("utf-8")
+        safe_name = re.sub(r"[^\w-]", "_", pack)
+        fname = f"{safe_name}-{sha1(content).hexdigest()[:12]}.json"
+        if not os.path.isfile(os.path.join(outdir, fname)):
+            ensuredir(outdir)
+            with open(os.path.join(outdir, fname), "wb") as fp:
+                fp.write(content)
+        env.mermaid_icon_subsets[pack] = f"_mermaid/icons/{fname}"
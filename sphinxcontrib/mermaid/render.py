@@ -0,0 +1,599 @@
+"""
+Build-time rendering of mermaid diagrams.
+
+Shared by the Sphinx translators and the ``sphinx-mermaid`` command line tool,
+so that both compute the same cache keys and output file names.
+"""
+
+from __future__ import annotations
+
+import importlib
+import json
+import os
+import re
+import shutil
+import textwrap
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+from fnmatch import fnmatch
+from functools import lru_cache
+from hashlib import sha1
+from types import SimpleNamespace
+from typing import NamedTuple
+
+import yaml
+from sphinx.util import logging
+from sphinx.util.osutil import ensuredir
+
+from .exceptions import MermaidError, MermaidRendererCrashed, MermaidRendererUnavailable, MermaidRenderTimeout
+from .renderers import get_renderer, mmdc_options
+
+logger = logging.getLogger(__name__)
+
+
+_FRONT_MATTER_RE = re.compile(r"\A---\n(.*?)\n?---(?:\n|\Z)", re.DOTALL)
+
+
+def canonical_code(code):
+    """Return a diagram source without formatting that does not affect its rendering.
+
+    Line endings, trailing whitespace, the common indentation and leading or
+    trailing blank lines are normalized, ``%%`` comments are dropped (``%%{...}%%``
+    directives are kept) and front matter is re-serialized with sorted keys.
+    """
+    code = code.replace("\r\n", "\n").replace("\r", "\n")
+    code = textwrap.dedent("\n".join(line.rstrip() for line in code.split("\n"))).strip("\n")
+    front_matter = ""
+    match = _FRONT_MATTER_RE.match(code)
+    if match:
+        try:
+            data = yaml.safe_load(match.group(1))
+        except yaml.YAMLError:
+            data = None
+        if isinstance(data, dict):
+            front_matter = "---\n" + yaml.safe_dump(data, sort_keys=True) + "---\n"
+            code = code[match.end() :]
+    lines = [line for line in code.split("\n") if not line.lstrip().startswith("%%") or line.lstrip().startswith("%%{")]
+    return front_matter + textwrap.dedent("\n".join(lines)).strip("\n")
+
+
+def render_key(code, options, config):
+    """Return the hash identifying the rendered output of a diagram.
+
+    The key is computed over :func:`canonical_code`, so re-indenting a diagram
+    or editing its comments does not invalidate its rendered output.
+    """
+    hashkey = (canonical_code(code) + str(options) + str(config.mermaid_sequence_config)).encode("utf-8")
+    return sha1(hashkey).hexdigest()
+
+
+def output_filename(code, options, config, fmt, prefix="mermaid"):
+    """Return the file name a diagram is rendered to."""
+    return f"{prefix}-{render_key(code, options, config)}.{fmt}"
+
+
+#: Defaults of ``mermaid_auto_policy``.
+AUTO_POLICY = {
+    "format": "svg",
+    "min_size": 2000,
+    "min_statements": 40,
+    "pages": [],
+    "prerender": None,
+}
+
+
+def diagram_statements(code):
+    """Estimate the size of a diagram as its number of non-comment lines."""
+    return sum(1 for line in code.splitlines() if line.strip() and not line.lstrip().startswith("%%"))
+
+
+def auto_policy(config):
+    """Return ``mermaid_auto_policy`` with defaults for the keys it does not set."""
+    return {**AUTO_POLICY, **(config.mermaid_auto_policy or {})}
+
+
+@lru_cache
+def import_function(path):
+    """Import the function named by ``"module.function"`` or ``"module:function"``."""
+    module, _sep, name = path.rpartition(":" if ":" in path else ".")
+    try:
+        return getattr(importlib.import_module(module), name)
+    except (ImportError, AttributeError, ValueError) as exc:
+        raise MermaidError(f"cannot import {path!r}: {exc}")
+
+
+def prerender_diagram(config, docname, code):
+    """Decide whether ``mermaid_output_format = "auto"`` renders a diagram at build time.
+
+    Large diagrams, and every diagram on the pages listed in the policy, are
+    rendered at build time; the browser renders the others. A ``prerender``
+    callable in the policy, or its import path, replaces these rules.
+    """
+    policy = auto_policy(config)
+    prerender = policy["prerender"]
+    if prerender is not None:
+        if isinstance(prerender, str):
+            prerender = import_function(prerender)
+        return bool(prerender(docname, code))
+    if any(fnmatch(docname, pattern) for pattern in policy["pages"]):
+        return True
+    if policy["min_size"] is not None and len(code) >= policy["min_size"]:
+        return True
+    return policy["min_statements"] is not None and diagram_statements(code) >= policy["min_statements"]
+
+
+def get_cache_dir(config, confdir):
+    """Return the absolute ``mermaid_cache_dir``, or None when it is not set."""
+    if not config.mermaid_cache_dir:
+        return None
+    return os.path.join(confdir, config.mermaid_cache_dir)
+
+
+#: Failures of the renderer rather than of the diagram, which are retried
+#: (``mermaid_render_retries``) and counted by :class:`CircuitBreaker`.
+RENDERER_FAILURES = (MermaidRenderTimeout, MermaidRendererCrashed, MermaidRendererUnavailable)
+
+
+class CircuitBreaker:
+    """Give up on the renderer after ``threshold`` consecutive failures.
+
+    Only timeouts, crashes and an unavailable renderer count as failures; a
+    diagram with a syntax error shows that the renderer works. Once open, the
+    remaining diagrams are not sent to the renderer at all, so a hung renderer
+    costs at most ``threshold`` timeouts per build. A threshold of 0 never
+    opens.
+    """
+
+    def __init__(self, threshold):
+        self.threshold = threshold
+        self.failures = 0
+        self._lock = threading.Lock()
+
+    @property
+    def open(self):
+        return bool(self.threshold) and self.failures >= self.threshold
+
+    def record(self, exc=None):
+        """Record the outcome of a render, ``exc`` being its exception if it failed."""
+        with self._lock:
+            if not isinstance(exc, RENDERER_FAILURES):
+                self.failures = 0
+                return
+            self.failures += 1
+            if self.failures == self.threshold:
+                logger.warning(
+                    f"mermaid rendering failed {self.failures} times in a row, the remaining diagrams are not rendered "
+                    "(see mermaid_render_max_failures)"
+                )
+
+
+def _remove(path):
+    # A killed or failed renderer may leave a partial file, which would
+    # otherwise be taken for a finished render by the next build.
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+_cairosvg_missing_reported = False
+
+
+def _cairosvg():
+    """Return the cairosvg module, or None when it or the cairo library is missing."""
+    global _cairosvg_missing_reported
+    try:
+        import cairosvg
+    except (ImportError, OSError) as exc:
+        if not _cairosvg_missing_reported:
+            _cairosvg_missing_reported = True
+            logger.info(f"mermaid_svg_convert needs cairosvg, rendering png and pdf with mermaid_renderer instead ({exc})")
+        return None
+    return cairosvg
+
+
+#: Diagram types drawn with SVG text only, never with HTML labels.
+_TEXT_LABEL_DIAGRAMS = re.compile(
+    r"^\s*(sequenceDiagram|gantt|pie|gitGraph|journey|quadrantChart|xychart(-beta)?|sankey(-beta)?"
+    r"|packet(-beta)?|C4(Context|Container|Component|Dynamic|Deployment))\b",
+    re.MULTILINE,
+)
+_HTML_LABELS_OFF_RE = re.compile(r"""\bhtmlLabels["']?\s*:\s*["']?false\b""")
+
+
+def may_have_html_labels(code, config):
+    """Return whether the SVG rendering of a diagram may hold HTML labels.
+
+    Only diagram types drawn with SVG text, and diagrams with ``htmlLabels``
+    turned off in their front matter, ``%%{init}%%`` directive or the
+    ``--configFile`` of ``mermaid_params``, are known to be free of them.
+    """
+    body = _FRONT_MATTER_RE.sub("", canonical_code(code), count=1)
+    body = "\n".join(line for line in body.split("\n") if not line.lstrip().startswith("%%"))
+    if _TEXT_LABEL_DIAGRAMS.match(body):
+        return False
+    if _HTML_LABELS_OFF_RE.search(code):
+        return False
+    _puppeteer_config, options = mmdc_options(config)
+    return not _HTML_LABELS_OFF_RE.search(json.dumps(options["mermaidConfig"]))
+
+
+def convert_svg(svgfn, outfn, fmt, config):
+    """Convert a rendered SVG file to ``png`` or ``pdf`` in process.
+
+    Returns False when the SVG cannot be converted faithfully: cairosvg is
+    missing, or the SVG has HTML labels (``foreignObject``) that cairo cannot
+    draw.
+    """
+    cairosvg = _cairosvg()
+    if cairosvg is None:
+        return False
+    with open(svgfn, "rb") as fp:
+        svg = fp.read()
+    if b"<foreignObject" in svg:
+        logger.debug(f"{svgfn} has HTML labels, rendering {fmt} with mermaid_renderer instead")
+        return False
+
+    _puppeteer_config, options = mmdc_options(config)
+    try:
+        if fmt == "png":
+            background = options["backgroundColor"]
+            cairosvg.svg2png(
+                bytestring=svg,
+                write_to=outfn,
+                scale=options["viewport"]["deviceScaleFactor"],
+                background_color=None if background == "transparent" else background,
+            )
+        else:
+            cairosvg.svg2pdf(bytestring=svg, write_to=outfn)
+    except (OSError, ValueError, SyntaxError) as exc:
+        _remove(outfn)
+        logger.warning(f"cannot convert {svgfn} to {fmt}, rendering it with mermaid_renderer instead: {exc}")
+        return False
+    return True
+
+
+#: Renders running a browser on this machine at a time, shared by every thread
+#: of the process: the writer, ``mermaid_render_ahead`` and :func:`render_diagrams`.
+BROWSER_SLOTS = threading.BoundedSemaphore(os.cpu_count() or 1)
+
+
+def _render(code, fmt, outfn, config, breaker):
+    """Run the renderer backend, returning False if it is unavailable.
+
+    Only failures of the renderer are retried: a diagram with a syntax error
+    fails the same way every time.
+    """
+    retries = config.mermaid_render_retries
+    for attempt in range(retries + 1):
+        try:
+            renderer = get_renderer(config)
+            with BROWSER_SLOTS if renderer.local_browser else nullcontext():
+                renderer.render(code, fmt, outfn, config)
+            break
+        except MermaidError as exc:
+            _remove(outfn)
+            if isinstance(exc, RENDERER_FAILURES) and attempt < retries:
+                logger.info(f"mermaid rendering failed, retrying ({attempt + 1}/{retries}): {exc}")
+                continue
+            if breaker is not None:
+                breaker.record(exc)
+            if isinstance(exc, MermaidRendererUnavailable):
+                logger.warning(str(exc))
+                return False
+            raise
+    if breaker is not None:
+        breaker.record()
+    return True
+
+
+def cached_output(fname, outdir, cachedir=None):
+    """Return the path of ``fname`` in ``outdir`` if it was rendered already.
+
+    A file found in ``cachedir`` is copied to ``outdir`` first. Returns None on
+    a cache miss.
+    """
+    outfn = os.path.join(outdir, fname)
+    if os.path.isfile(outfn):
+        return outfn
+    if cachedir:
+        cachedfn = os.path.join(cachedir, fname)
+        if os.path.isfile(cachedfn):
+            ensuredir(outdir)
+            shutil.copyfile(cachedfn, outfn)
+            return outfn
+    return None
+
+
+def render_to(code, options, fmt, outdir, config, cachedir=None, prefix="mermaid", breaker=None, svgdir=None):
+    """Render a diagram into ``outdir`` unless it is already there.
+
+    When ``cachedir`` is given, a previously rendered file found there is copied
+    instead of invoking the renderer, and freshly rendered files are stored in it.
+    Failed renders are retried ``mermaid_render_retries`` times.
+    With ``mermaid_svg_convert``, PNG and PDF files are converted from the SVG
+    rendering of the diagram, which is kept in ``svgdir`` (by default
+    ``cachedir``, else ``outdir``) for the other formats. Diagrams that
+    :func:`may_have_html_labels` are rendered in the requested format instead,
+    unless their SVG is kept already, and SVG output is taken from and kept in
+    ``svgdir`` too.
+    Returns the output path, or None if the renderer backend is unavailable or
+    ``breaker`` is open.
+    """
+    convert = config.mermaid_svg_convert and svgdir is not None
+    fname = output_filename(code, options, config, fmt, prefix)
+    outfn = cached_output(fname, outdir, cachedir)
+    if outfn is None and fmt == "svg" and convert:
+        outfn = cached_output(fname, outdir, svgdir)
+    if outfn is not None:
+        return outfn
+
+    outfn = os.path.join(outdir, fname)
+    ensuredir(outdir)
+
+    if breaker is not None and breaker.open:
+        return None
+
+    converted = False
+    if fmt in ("png", "pdf") and config.mermaid_svg_convert and _cairosvg() is not None:
+        svgdir = svgdir or cachedir or outdir
+        svgname = output_filename(code, options, config, "svg", prefix)
+        svgfn = cached_output(svgname, svgdir, cachedir)
+        if svgfn is None and not may_have_html_labels(code, config):
+            svgfn = render_to(code, options, "svg", svgdir, config, cachedir, prefix, breaker)
+            if svgfn is None:
+                return None
+        if svgfn is not None:
+            converted = convert_svg(svgfn, outfn, fmt, config)
+    if not converted and not _render(code, fmt, outfn, config, breaker):
+        return None
+
+    # The SVG kept for conversions may be rendered straight into the cache.
+    keepdirs = {os.path.abspath(d) for d in (cachedir, svgdir if fmt == "svg" and convert else None) if d}
+    for keepdir in keepdirs:
+        if keepdir != os.path.abspath(outdir):
+            ensuredir(keepdir)
+            shutil.copyfile(outfn, os.path.join(keepdir, fname))
+    return outfn
+
+
+class RenderQueue:
+    """Render diagrams in background threads while the build goes on.
+
+    Jobs are identified by their output file name; a diagram queued twice is
+    rendered once. The queue belongs to the process that created it, forked
+    processes must not submit to it or wait on unfinished jobs.
+    """
+
+    def __init__(self, workers, config, outdir, cachedir=None, svgdir=None, breaker=None):
+        self.pid = os.getpid()
+        self.config = config
+        self.outdir = outdir
+        self.cachedir = cachedir
+        self.svgdir = svgdir
+        self.breaker = breaker
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="mermaid-render")
+        self._futures = {}
+        self._lock = threading.Lock()
+
+    def submit(self, code, options, fmt, prefix="mermaid"):
+        """Queue a diagram unless it is queued or rendered already."""
+        fname = output_filename(code, options, self.config, fmt, prefix)
+        with self._lock:
+            if fname in self._futures or os.path.isfile(os.path.join(self.outdir, fname)):
+                return
+            self._futures[fname] = self._executor.submit(
+                render_to, code, options, fmt, self.outdir, self.config, self.cachedir, prefix, self.breaker, self.svgdir
+            )
+
+    def __contains__(self, fname):
+        return fname in self._futures
+
+    def result(self, fname):
+        """Wait for a queued diagram and return its :func:`render_to` result.
+
+        Raises the :class:`MermaidError` the background render failed with.
+        """
+        return self._futures[fname].result()
+
+    def drain(self, cancel=False):
+        """Wait until every queued diagram is rendered, or dropped with ``cancel``."""
+        for future in list(self._futures.values()):
+            if not (cancel and future.cancel()):
+                future.exception()
+
+    def finish(self, cancel=False):
+        """Drain the queue and forget its jobs, ready for the next build."""
+        self.drain(cancel)
+        with self._lock:
+            self._futures.clear()
+
+
+#: Defaults of the settings used for rendering, for :func:`render_diagram`
+#: calls made without a Sphinx configuration.
+RENDER_DEFAULTS = {
+    "mermaid_renderer": None,
+    "mermaid_renderer_url": "http://localhost:8000/mermaid/{format}",
+    "mermaid_cmd": "mmdc",
+    "mermaid_cmd_shell": "False",
+    "mermaid_params": [],
+    "mermaid_sequence_config": None,
+    "mermaid_verbose": False,
+    "mermaid_daemon_cmd": None,
+    "mermaid_daemon_idle_timeout": 600,
+    "mermaid_daemon_state_file": None,
+    "mermaid_render_timeout": 120,
+    "mermaid_render_retries": 0,
+    "mermaid_render_max_failures": 5,
+    "mermaid_svg_convert": False,
+    "mermaid_cache_dir": None,
+}
+
+
+class RenderResult(NamedTuple):
+    """The outcome of :func:`render_diagram`."""
+
+    #: Path of the rendered file, None if rendering failed.
+    path: str | None
+    #: File name, derived from the diagram's render key.
+    filename: str
+    #: ``"svg"``, ``"png"`` or ``"pdf"``.
+    format: str
+    #: Hash identifying the rendered output, see :func:`render_key`.
+    key: str
+    #: Whether the file was rendered before and taken from the output or cache directory.
+    cached: bool
+    #: The :class:`MermaidError` that made rendering fail, for :func:`render_diagrams`.
+    error: MermaidError | None = None
+
+
+def _as_config(config):
+    if config is None or isinstance(config, dict):
+        return SimpleNamespace(**{**RENDER_DEFAULTS, **(config or {})})
+    return config
+
+
+def _render_diagram(code, fmt, config, outdir, cachedir, options, prefix, breaker):
+    if cachedir and os.path.abspath(cachedir) == os.path.abspath(outdir):
+        cachedir = None
+    key = render_key(code, options, config)
+    fname = f"{prefix}-{key}.{fmt}"
+    cached = cached_output(fname, outdir, cachedir) is not None
+    outfn = render_to(code, options, fmt, outdir, config, cachedir, prefix, breaker)
+    if outfn is None:
+        if breaker is not None and breaker.open:
+            raise MermaidRendererUnavailable(f"skipped after {breaker.failures} consecutive renderer failures")
+        raise MermaidRendererUnavailable("the mermaid renderer is unavailable")
+    return RenderResult(outfn, fname, fmt, key, cached)
+
+
+def render_diagram(code, fmt="svg", config=None, outdir=None, confdir=None, options=None, prefix="mermaid"):
+    """Render a diagram outside of a Sphinx build, with the extension's cache and renderer.
+
+    ``config`` is a Sphinx configuration (``app.config``), a dict of
+    ``mermaid_*`` settings overriding :data:`RENDER_DEFAULTS`, or None for the
+    defaults. The file is rendered into ``outdir``, by default
+    ``mermaid_cache_dir`` (relative to ``confdir``, by default the current
+    directory), so builds sharing that cache reuse it and the other way round.
+    Renderer backends are shared with the builds of the process.
+
+    Returns a :class:`RenderResult`; raises :class:`MermaidError` when
+    rendering fails.
+    """
+    config = _as_config(config)
+    cachedir = get_cache_dir(config, confdir or os.getcwd())
+    outdir = outdir or cachedir
+    if not outdir:
+        raise MermaidError("no destination, set mermaid_cache_dir or pass outdir")
+    return _render_diagram(code, fmt, config, outdir, cachedir, options or {}, prefix, None)
+
+
+def render_diagrams(codes, fmt="svg", config=None, outdir=None, confdir=None, options=None, prefix="mermaid", jobs=None):
+    """Render many diagrams with up to ``jobs`` renders at a time.
+
+    Renders that run a browser on this machine also wait for one of the
+    process-wide :data:`BROWSER_SLOTS`, so calls made during a build do not
+    add to the browsers of the build and of ``mermaid_render_ahead``.
+
+    Takes the arguments of :func:`render_diagram` and returns a
+    :class:`RenderResult` per diagram, in order. A failed diagram does not stop
+    the others, its result carries the ``error`` instead. Identical diagrams
+    are rendered once, and after ``mermaid_render_max_failures`` consecutive
+    timeouts the remaining diagrams are skipped.
+    """
+    config = _as_config(config)
+    cachedir = get_cache_dir(config, confdir or os.getcwd())
+    outdir = outdir or cachedir
+    if not outdir:
+        raise MermaidError("no destination, set mermaid_cache_dir or pass outdir")
+    options = options or {}
+    breaker = CircuitBreaker(config.mermaid_render_max_failures)
+
+    def render(code):
+        try:
+            return _render_diagram(code, fmt, config, outdir, cachedir, options, prefix, breaker)
+        except MermaidError as exc:
+            fname = output_filename(code, options, config, fmt, prefix)
+            return RenderResult(None, fname, fmt, render_key(code, options, config), False, exc)
+
+    codes = list(codes)
+    unique = {output_filename(code, options, config, fmt, prefix): code for code in codes}
+    with ThreadPoolExecutor(max_workers=max(jobs or os.cpu_count() or 1, 1)) as executor:
+        results = dict(zip(unique, executor.map(render, unique.values())))
+    return [results[output_filename(code, options, config, fmt, prefix)] for code in codes]
+
+
+#: Version of the render manifest format.
+MANIFEST_VERSION = 1
+
+#: Settings a render manifest carries to the machines rendering it.
+MANIFEST_CONFIG = tuple(name for name in RENDER_DEFAULTS if name != "mermaid_cache_dir")
+
+
+def manifest_job(code, options, fmt, config, prefix="mermaid", docname=None):
+    """Return the render manifest entry of a diagram."""
+    return {
+        "filename": output_filename(code, options, config, fmt, prefix),
+        "format": fmt,
+        "prefix": prefix,
+        "code": code,
+        "options": options,
+        "docnames": [docname] if docname else [],
+    }
+
+
+def write_manifest(path, jobs, config):
+    """Write a render manifest listing ``jobs`` and the settings to render them with.
+
+    Jobs for the same output file are merged.
+    """
+    settings = {name: getattr(config, name) for name in MANIFEST_CONFIG}
+    if callable(settings["mermaid_renderer"]):
+        raise MermaidError("a callable mermaid_renderer cannot be written to a render manifest")
+    merged = {}
+    for job in jobs:
+        entry = merged.setdefault(job["filename"], {**job, "docnames": []})
+        entry["docnames"] = sorted(set(entry["docnames"]) | set(job["docnames"]))
+    data = {
+        "version": MANIFEST_VERSION,
+        "config": settings,
+        "jobs": [merged[fname] for fname in sorted(merged)],
+    }
+    ensuredir(os.path.dirname(os.path.abspath(path)))
+    with open(path, "w", encoding="utf-8") as fp:
+        json.dump(data, fp, indent=1, sort_keys=True)
+    return len(merged)
+
+
+def read_manifest(path):
+    """Return the settings and the jobs of a render manifest.
+
+    The settings are returned as a config-like object for :func:`render_to`.
+    """
+    try:
+        with open(path, encoding="utf-8") as fp:
+            data = json.load(fp)
+    except (OSError, ValueError) as exc:
+        raise MermaidError(f"cannot read render manifest {path!r}: {exc}") from exc
+    if data.get("version") != MANIFEST_VERSION:
+        raise MermaidError(f"render manifest {path!r} has version {data.get('version')!r}, expected {MANIFEST_VERSION}")
+    config = _as_config(data["config"])
+    for job in data["jobs"]:
+        # A file name computed by another version of the extension would not
+        # be found by the build.
+        fname = output_filename(job["code"], job["options"], config, job["format"], job["prefix"])
+        if fname != job["filename"]:
+            raise MermaidError(f"render manifest {path!r} was written by an incompatible version ({job['filename']} != {fname})")
+    return config, data["jobs"]
+
+
+def shard_jobs(jobs, index, count):
+    """Return the ``index``-th (1-based) of ``count`` equally sized shards of ``jobs``.
+
+    ``jobs`` maps output file names to jobs; shards are cut from the sorted
+    file names, so they do not depend on the order jobs were collected in.
+    """
+    if not 1 <= index <= count:
+        raise ValueError(f"shard {index}/{count} does not exist")
+    return dict(sorted(jobs.items())[index - 1 :: count])
@@ -0,0 +1,120 @@
+// Long-lived mermaid renderer used by the "daemon" backend of sphinxcontrib-mermaid.
+//
+// Launches one headless browser through mermaid-cli and serves render requests
+// on a localhost TCP port, so consecutive builds (e.g. sphinx-autobuild
+// rebuilds) skip the browser cold start. The port, pid and an access token are
+// written to the --state file; the daemon exits after --idle-timeout seconds
+// without requests.
+//
+// Protocol: one JSON object per line in each direction.
+//   request:  {"token", "command": "render", "code", "format", "options"}
+//             {"token", "command": "ping" | "shutdown"}
+//   response: {"ok": true, "data": "<base64>"} or {"ok": false, "error": "..."}
+
+import { execSync } from "node:child_process";
+import { randomBytes } from "node:crypto";
+import { readFileSync, renameSync, rmSync, writeFileSync } from "node:fs";
+import { createRequire } from "node:module";
+import { createServer } from "node:net";
+import { join } from "node:path";
+import { pathToFileURL } from "node:url";
+import { parseArgs } from "node:util";
+
+const { values: args } = parseArgs({
+    options: {
+        state: { type: "string" },
+        "idle-timeout": { type: "string", default: "600" },
+        "puppeteer-config": { type: "string" },
+    },
+});
+if (!args.state) {
+    console.error("usage: renderer_daemon.mjs --state FILE [--idle-timeout SECONDS] [--puppeteer-config FILE]");
+    process.exit(2);
+}
+
+// mermaid-cli is usually installed globally (npm install -g), where a bare
+// import does not find it, so fall back to the global node_modules.
+const importMermaidCli = async () => {
+    try {
+        return { cli: await import("@mermaid-js/mermaid-cli"), puppeteer: await import("puppeteer") };
+    } catch {
+        const cliDir = join(execSync("npm root -g", { encoding: "utf8" }).trim(), "@mermaid-js", "mermaid-cli");
+        const require = createRequire(join(cliDir, "package.json"));
+        return {
+            cli: await import(pathToFileURL(join(cliDir, "src", "index.js")).href),
+            puppeteer: await import(pathToFileURL(require.resolve("puppeteer")).href),
+        };
+    }
+};
+
+const { cli, puppeteer } = await importMermaidCli();
+const puppeteerConfig = args["puppeteer-config"] ? JSON.parse(readFileSync(args["puppeteer-config"], "utf8")) : {};
+const browser = await (puppeteer.default ?? puppeteer).launch({ headless: "shell", ...puppeteerConfig });
+
+const token = randomBytes(16).toString("hex");
+const idleTimeout = parseFloat(args["idle-timeout"]) * 1000;
+let idleTimer = null;
+let active = 0;
+
+const shutdown = async () => {
+    server.close();
+    try {
+        if (JSON.parse(readFileSync(args.state, "utf8")).pid === process.pid) rmSync(args.state, { force: true });
+    } catch {}
+    await browser.close().catch(() => {});
+    process.exit(0);
+};
+
+const resetIdleTimer = () => {
+    clearTimeout(idleTimer);
+    if (active === 0) idleTimer = setTimeout(shutdown, idleTimeout);
+};
+
+const handle = async (line) => {
+    active++;
+    clearTimeout(idleTimer);
+    try {
+        const request = JSON.parse(line);
+        if (request.token !== token) return { ok: false, error: "invalid token" };
+        if (request.command === "ping") return { ok: true };
+        if (request.command === "shutdown") {
+            setImmediate(shutdown);
+            return { ok: true };
+        }
+        const { data } = await cli.renderMermaid(browser, request.code, request.format, request.options ?? {});
+        return { ok: true, data: Buffer.from(data).toString("base64") };
+    } catch (error) {
+        return { ok: false, error: String(error?.message ?? error) };
+    } finally {
+        active--;
+        resetIdleTimer();
+    }
+};
+
+const server = createServer((socket) => {
+    // Requests on one connection are answered in order; concurrent renders
+    // use separate connections.
+    let buffer = "";
+    let queue = Promise.resolve();
+    socket.setEncoding("utf8");
+    socket.on("error", () => {});
+    socket.on("data", (chunk) => {
+        buffer += chunk;
+        let newline;
+        while ((newline = buffer.indexOf("\n")) >= 0) {
+            const line = buffer.slice(0, newline);
+            buffer = buffer.slice(newline + 1);
+            queue = queue.then(() => handle(line)).then((response) => socket.write(JSON.stringify(response) + "\n"));
+        }
+    });
+});
+
+server.listen(0, "127.0.0.1", () => {
+    const tmp = `${args.state}.${process.pid}`;
+    writeFileSync(tmp, JSON.stringify({ port: server.address().port, pid: process.pid, token }), { mode: 0o600, flag: "wx" });
+    renameSync(tmp, args.state);
+    resetIdleTimer();
+});
+
+process.on("SIGTERM", shutdown);
+process.on("SIGINT", shutdown);
@@ -0,0 +1,509 @@
+"""
+Renderer backends used for build-time (non-``raw``) output.
+
+A backend turns mermaid code into a rendered file. The one in use is picked by
+the ``mermaid_renderer`` config value, which may name a registered backend
+(``"mmdc"``, ``"http"`` or ``"daemon"``), be a :class:`Renderer` instance, or be a plain
+callable ``func(code, fmt)`` returning the rendered bytes or text.
+"""
+
+from __future__ import annotations
+
+import argparse
+import base64
+import http.client
+import json
+import os
+import re
+import shlex
+import signal
+import socket
+import subprocess
+import threading
+import time
+from queue import Empty, LifoQueue
+from subprocess import DEVNULL, PIPE, Popen
+from tempfile import TemporaryDirectory
+from typing import ClassVar
+from urllib.parse import urlsplit
+
+from sphinx.util import logging
+
+from .exceptions import MermaidError, MermaidRendererCrashed, MermaidRendererUnavailable, MermaidRenderTimeout
+
+logger = logging.getLogger(__name__)
+
+# mermaid-cli errors of a headless browser that crashed or was killed, as
+# opposed to errors in the diagram.
+_BROWSER_CRASH_RE = re.compile(
+    r"Target closed|Session closed|Browser closed|Protocol error|browser has disconnected|Failed to launch the browser process"
+)
+
+
+def render_timeout(config):
+    """Return ``mermaid_render_timeout`` in seconds, or None for no limit."""
+    return getattr(config, "mermaid_render_timeout", None) or None
+
+
+def kill_process_tree(process):
+    """Kill ``process`` together with the processes it started, and reap it.
+
+    mermaid-cli runs a headless browser in child processes, which would keep
+    running if only the direct child was killed.
+    """
+    try:
+        if os.name == "nt":
+            subprocess.run(["taskkill", "/F", "/T", "/PID", str(process.pid)], stdout=DEVNULL, stderr=DEVNULL, check=False)
+        else:
+            os.killpg(process.pid, signal.SIGKILL)
+    except OSError:
+        pass
+    process.kill()
+    try:
+        process.communicate(timeout=5)
+    except subprocess.TimeoutExpired:
+        # A grandchild that left the process group still holds the pipes.
+        pass
+
+
+class Renderer:
+    """Base class of renderer backends.
+
+    Subclasses implement :meth:`render`, and must be safe to call from several
+    threads at once.
+    """
+
+    #: Whether rendering runs a browser on this machine; such renders share
+    #: :data:`~sphinxcontrib.mermaid.render.BROWSER_SLOTS`.
+    local_browser = False
+
+    @classmethod
+    def from_config(cls, config):
+        return cls()
+
+    def render(self, code, fmt, outfn, config):
+        """Render ``code`` in format ``fmt`` into the file ``outfn``.
+
+        Raises :class:`MermaidRendererUnavailable` when the backend cannot be
+        reached at all, and :class:`MermaidError` when rendering fails.
+        """
+        raise NotImplementedError
+
+    def close(self):
+        """Release resources held between renders."""
+
+
+class CommandRenderer(Renderer):
+    """Run the ``mermaid_cmd`` program (mermaid-cli) once per diagram."""
+
+    local_browser = True
+
+    def render(self, code, fmt, outfn, config):
+        mermaid_cmd = config.mermaid_cmd
+        mermaid_cmd_shell = config.mermaid_cmd_shell in {True, "True", "true"}
+
+        # Files of a killed browser may still be locked on Windows.
+        with TemporaryDirectory(ignore_cleanup_errors=True) as tempDir:
+            tmpfn = os.path.join(tempDir, os.path.splitext(os.path.basename(outfn))[0])
+            with open(tmpfn, "w", encoding="utf-8") as t:
+                t.write(code)
+
+            if isinstance(mermaid_cmd, str):
+                mm_args = shlex.split(mermaid_cmd)
+            else:
+                mm_args = list(mermaid_cmd)
+
+            mm_args.extend(config.mermaid_params)
+            mm_args += ["-i", tmpfn, "-o", outfn]
+            if config.mermaid_sequence_config:
+                mm_args.extend(["--configFile", config.mermaid_sequence_config])
+
+            # In its own process group, so that a timeout can kill the browser too.
+            if os.name == "nt":
+                group = {"creationflags": subprocess.CREATE_NEW_PROCESS_GROUP}
+            else:
+                group = {"start_new_session": True}
+            try:
+                p = Popen(mm_args, shell=mermaid_cmd_shell, stdout=PIPE, stdin=PIPE, stderr=PIPE, text=True, **group)
+            except FileNotFoundError:
+                raise MermaidRendererUnavailable(f"command {mermaid_cmd!r} cannot be run (needed for mermaid output), check the mermaid_cmd setting")
+            timeout = render_timeout(config)
+            try:
+                stdout, stderr = p.communicate(code, timeout=timeout)
+            except subprocess.TimeoutExpired:
+                kill_process_tree(p)
+                raise MermaidRenderTimeout(f"Mermaid did not finish within {timeout} seconds and was killed")
+            except BaseException:
+                # Ctrl-C does not reach a process in its own session.
+                kill_process_tree(p)
+                raise
+            if config.mermaid_verbose:
+                logger.info(stdout)
+
+            if p.returncode < 0 or (p.returncode != 0 and _BROWSER_CRASH_RE.search(stderr)):
+                raise MermaidRendererCrashed(f"Mermaid crashed (exit status {p.returncode}):\n[stderr]\n{stderr}\n[stdout]\n{stdout}")
+            if p.returncode != 0:
+                raise MermaidError(f"Mermaid exited with error:\n[stderr]\n{stderr}\n[stdout]\n{stdout}")
+            if not os.path.isfile(outfn):
+                raise MermaidError(f"Mermaid did not produce an output file:\n[stderr]\n{stderr}\n[stdout]\n{stdout}")
+
+
+class CallableRenderer(Renderer):
+    """Call a Python function ``func(code, fmt)`` returning the rendered output."""
+
+    def __init__(self, func):
+        self.func = func
+
+    def render(self, code, fmt, outfn, config):
+        output = self.func(code, fmt)
+        if not output:
+            raise MermaidError(f"Mermaid renderer {self.func!r} returned no output")
+        if isinstance(output, str):
+            output = output.encode("utf-8")
+        with open(outfn, "wb") as out:
+            out.write(output)
+
+
+class HTTPRenderer(Renderer):
+    """POST diagrams to a rendering service, such as a local Kroki container.
+
+    ``url`` may contain a ``{format}`` placeholder. Idle keep-alive connections
+    are pooled and reused, and each concurrent render uses its own connection.
+    """
+
+    _instances: ClassVar[dict[str, HTTPRenderer]] = {}
+    _instances_lock = threading.Lock()
+
+    def __init__(self, url):
+        self.url = url
+        self._pool = LifoQueue()
+
+    @classmethod
+    def from_config(cls, config):
+        # One pool per service, shared by every build in the process.
+        with cls._instances_lock:
+            if config.mermaid_renderer_url not in cls._instances:
+                cls._instances[config.mermaid_renderer_url] = cls(config.mermaid_renderer_url)
+            return cls._instances[config.mermaid_renderer_url]
+
+    def _new_connection(self, parts, timeout=None):
+        connection_class = http.client.HTTPSConnection if parts.scheme == "https" else http.client.HTTPConnection
+        return connection_class(parts.hostname, parts.port, timeout=timeout)
+
+    def render(self, code, fmt, outfn, config):
+        url = self.url.format(format=fmt)
+        parts = urlsplit(url)
+        if parts.scheme not in ("http", "https"):
+            raise MermaidError(f"mermaid_renderer_url must be an http(s) URL, but is {self.url!r}")
+        path = parts.path or "/"
+        if parts.query:
+            path += "?" + parts.query
+
+        timeout = render_timeout(config)
+        try:
+            connection, reused = self._pool.get_nowait(), True
+            connection.timeout = timeout
+        except Empty:
+            connection, reused = self._new_connection(parts, timeout), False
+
+        while True:
+            try:
+                if connection.sock is not None:
+                    connection.sock.settimeout(timeout)
+                connection.request("POST", path, body=code.encode("utf-8"), headers={"Content-Type": "text/plain; charset=utf-8"})
+                response = connection.getresponse()
+                data = response.read()
+                break
+            except (OSError, http.client.HTTPException) as exc:
+                connection.close()
+                if isinstance(exc, TimeoutError):
+                    raise MermaidRenderTimeout(f"Mermaid renderer at {url!r} did not answer within {timeout} seconds")
+                if reused:
+                    # The service may have dropped an idle keep-alive connection.
+                    connection, reused = self._new_connection(parts, timeout), False
+                    continue
+                if isinstance(exc, ConnectionRefusedError):
+                    raise MermaidRendererUnavailable(f"mermaid renderer at {url!r} cannot be reached, check the mermaid_renderer_url setting")
+                raise MermaidRendererCrashed(f"Mermaid renderer at {url!r} failed: {exc}")
+
+        if response.will_close:
+            connection.close()
+        else:
+            self._pool.put(connection)
+
+        if response.status != 200:
+            raise MermaidError(f"Mermaid renderer at {url!r} returned HTTP {response.status}:\n{data.decode('utf-8', 'replace')}")
+        with open(outfn, "wb") as out:
+            out.write(data)
+
+    def close(self):
+        while True:
+            try:
+                self._pool.get_nowait().close()
+            except Empty:
+                break
+
+
+_DAEMON_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "renderer_daemon.mjs")
+
+
+def default_daemon_state_file():
+    """Return the state file in a directory only the current user can access.
+
+    The state file holds the daemon's access token, so it is kept out of the
+    shared temporary directory: in ``$XDG_RUNTIME_DIR``, or in ``~/.cache``.
+    """
+    base = os.environ.get("XDG_RUNTIME_DIR") or os.path.join(os.path.expanduser("~"), ".cache")
+    directory = os.path.join(base, "sphinxcontrib-mermaid")
+    os.makedirs(directory, mode=0o700, exist_ok=True)
+    # An existing directory keeps its mode; tighten it if it is ours.
+    if os.name != "nt" and os.stat(directory).st_uid == os.getuid():
+        os.chmod(directory, 0o700)
+    return os.path.join(directory, "daemon.json")
+
+
+def _private_file(fp):
+    """Whether the open file ``fp`` belongs to the current user and only them."""
+    if os.name == "nt":
+        return True
+    st = os.fstat(fp.fileno())
+    return st.st_uid == os.getuid() and not st.st_mode & 0o077
+
+
+def mmdc_options(config):
+    """Translate ``mermaid_params`` into renderMermaid options, as mermaid-cli does.
+
+    Used by the daemon renderer, and for the size and background of PNG files
+    converted from SVG.
+
+    Returns the puppeteer config file, if any, and the render options.
+    """
+    parser = argparse.ArgumentParser(add_help=False, exit_on_error=False)
+    parser.add_argument("-t", "--theme", default="default")
+    parser.add_argument("-w", "--width", type=int, default=800)
+    parser.add_argument("-H", "--height", type=int, default=600)
+    parser.add_argument("-b", "--backgroundColor", default="white")
+    parser.add_argument("-c", "--configFile")
+    parser.add_argument("-C", "--cssFile")
+    parser.add_argument("-s", "--scale", type=float, default=1)
+    parser.add_argument("-f", "--pdfFit", action="store_true")
+    parser.add_argument("-p", "--puppeteerConfigFile")
+    try:
+        args, _unknown = parser.parse_known_args([str(param) for param in config.mermaid_params])
+    except argparse.ArgumentError as exc:
+        raise MermaidError(f"mermaid_params cannot be used with the daemon renderer: {exc}")
+
+    mermaid_config = {"theme": args.theme}
+    for config_file in (args.configFile, config.mermaid_sequence_config):
+        if config_file:
+            with open(config_file, encoding="utf-8") as fp:
+                mermaid_config.update(json.load(fp))
+    options = {
+        "viewport": {"width": args.width, "height": args.height, "deviceScaleFactor": args.scale},
+        "backgroundColor": args.backgroundColor,
+        "mermaidConfig": mermaid_config,
+        "pdfFit": args.pdfFit,
+    }
+    if args.cssFile:
+        with open(args.cssFile, encoding="utf-8") as fp:
+            options["myCSS"] = fp.read()
+    return args.puppeteerConfigFile, options
+
+
+class _DaemonConnection:
+    def __init__(self, sock, token):
+        self.sock = sock
+        self.rfile = sock.makefile("rb")
+        self.token = token
+
+    def request(self, payload):
+        self.sock.sendall(json.dumps({"token": self.token, **payload}).encode("utf-8") + b"\n")
+        line = self.rfile.readline()
+        if not line:
+            raise ConnectionError("connection closed by the mermaid renderer daemon")
+        return json.loads(line)
+
+    def close(self):
+        self.rfile.close()
+        self.sock.close()
+
+
+class DaemonRenderer(Renderer):
+    """Render through a long-lived ``renderer_daemon.mjs`` process.
+
+    The daemon keeps a headless browser warm between builds. It is started on
+    first use, or reused when ``state_file`` points at a running one, and exits
+    by itself after ``idle_timeout`` seconds without requests.
+    """
+
+    local_browser = True
+    _instances: ClassVar[dict[str, DaemonRenderer]] = {}
+    _instances_lock = threading.Lock()
+    startup_timeout = 60
+
+    def __init__(self, command, state_file, idle_timeout=600, puppeteer_config=None):
+        self.command = shlex.split(command) if isinstance(command, str) else list(command)
+        self.state_file = state_file
+        self.idle_timeout = idle_timeout
+        self.puppeteer_config = puppeteer_config
+        self._pool = LifoQueue()
+        self._start_lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, config):
+        state_file = config.mermaid_daemon_state_file or default_daemon_state_file()
+        with cls._instances_lock:
+            if state_file not in cls._instances:
+                puppeteer_config, _options = mmdc_options(config)
+                cls._instances[state_file] = cls(
+                    config.mermaid_daemon_cmd or ["node", _DAEMON_SCRIPT],
+                    state_file,
+                    config.mermaid_daemon_idle_timeout,
+                    puppeteer_config and os.path.abspath(puppeteer_config),
+                )
+            return cls._instances[state_file]
+
+    def _connect(self):
+        """Connect to the daemon named in the state file, or return None."""
+        try:
+            with open(self.state_file, encoding="utf-8") as fp:
+                if not _private_file(fp):
+                    logger.warning(f"ignoring mermaid renderer daemon state file {self.state_file}: not private to the current user")
+                    return None
+                state = json.load(fp)
+            connection = _DaemonConnection(socket.create_connection(("127.0.0.1", state["port"]), timeout=5), state["token"])
+        except (OSError, ValueError, KeyError):
+            return None
+        try:
+            if connection.request({"command": "ping"}).get("ok"):
+                connection.sock.settimeout(None)
+                return connection
+        except (OSError, ValueError):
+            pass
+        connection.close()
+        return None
+
+    def _start(self):
+        args = [*self.command, "--state", self.state_file, "--idle-timeout", str(self.idle_timeout)]
+        if self.puppeteer_config:
+            args += ["--puppeteer-config", self.puppeteer_config]
+        if os.name == "nt":
+            detach = {"creationflags": subprocess.DETACHED_PROCESS | subprocess.CREATE_NEW_PROCESS_GROUP}
+        else:
+            detach = {"start_new_session": True}
+
+        logfn = self.state_file + ".log"
+        if os.path.lexists(logfn):
+            os.remove(logfn)
+        # Created anew, so that a planted symlink cannot redirect the output.
+        with open(os.open(logfn, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600), "wb") as log:
+            try:
+                process = Popen(args, stdin=DEVNULL, stdout=log, stderr=log, **detach)
+            except FileNotFoundError:
+                raise MermaidRendererUnavailable(
+                    f"command {self.command!r} cannot be run (needed for the mermaid renderer daemon), check the mermaid_daemon_cmd setting"
+                )
+
+        deadline = time.monotonic() + self.startup_timeout
+        while time.monotonic() < deadline:
+            connection = self._connect()
+            if connection is not None:
+                return connection
+            if process.poll() is not None:
+                with open(logfn, encoding="utf-8", errors="replace") as log:
+                    raise MermaidRendererUnavailable(f"mermaid renderer daemon exited with status {process.returncode}:\n{log.read()}")
+            time.sleep(0.05)
+        process.kill()
+        raise MermaidRendererUnavailable(f"mermaid renderer daemon did not start within {self.startup_timeout} seconds")
+
+    def _acquire(self):
+        try:
+            return self._pool.get_nowait(), True
+        except Empty:
+            pass
+        connection = self._connect()
+        if connection is None:
+            with self._start_lock:
+                connection = self._connect() or self._start()
+        return connection, False
+
+    def render(self, code, fmt, outfn, config):
+        request = {"command": "render", "code": code, "format": fmt, "options": mmdc_options(config)[1]}
+        timeout = render_timeout(config)
+        connection, reused = self._acquire()
+        while True:
+            try:
+                connection.sock.settimeout(timeout)
+                response = connection.request(request)
+                break
+            except (OSError, ValueError) as exc:
+                connection.close()
+                if isinstance(exc, TimeoutError):
+                    # The daemon finishes the abandoned render on its own, the
+                    # answer is dropped with the connection.
+                    raise MermaidRenderTimeout(f"Mermaid renderer daemon did not answer within {timeout} seconds")
+                if not reused:
+                    raise MermaidRendererCrashed(f"Mermaid renderer daemon failed: {exc}")
+                # The daemon may have exited after its idle timeout.
+                connection, reused = self._acquire()
+        self._pool.put(connection)
+
+        if not response.get("ok"):
+            raise MermaidError(f"Mermaid renderer daemon failed to render:\n{response.get('error')}")
+        with open(outfn, "wb") as out:
+            out.write(base64.b64decode(response["data"]))
+
+    def stop(self):
+        """Ask a running daemon to shut down."""
+        self.close()
+        connection = self._connect()
+        if connection is not None:
+            try:
+                connection.request({"command": "shutdown"})
+            except (OSError, ValueError):
+                pass
+            connection.close()
+
+    def close(self):
+        while True:
+            try:
+                self._pool.get_nowait().close()
+            except Empty:
+                break
+
+
+RENDERERS: dict[str, type[Renderer]] = {
+    "mmdc": CommandRenderer,
+    "http": HTTPRenderer,
+    "daemon": DaemonRenderer,
+}
+
+
+def register_renderer(name, renderer_class):
+    """Make ``renderer_class`` selectable as ``mermaid_renderer = name``."""
+    RENDERERS[name] = renderer_class
+
+
+def get_renderer(config):
+    """Return the renderer backend selected by ``mermaid_renderer``."""
+    renderer = config.mermaid_renderer or "mmdc"
+    if isinstance(renderer, Renderer):
+        return renderer
+    if isinstance(renderer, type) and issubclass(renderer, Renderer):
+        return renderer.from_config(config)
+    if isinstance(renderer, str) and renderer in RENDERERS:
+        return RENDERERS[renderer].from_config(config)
+    if callable(renderer):
+        return CallableRenderer(renderer)
+    raise MermaidError(f"mermaid_renderer must be one of {sorted(RENDERERS)} or a callable, but is {renderer!r}")
+
+
+def close_renderers(app=None, exception=None):
+    """Close pooled connections; connected to ``build-finished``.
+
+    A renderer daemon keeps running, to be reused by the next build.
+    """
+    for renderer_class in (HTTPRenderer, DaemonRenderer):
+        with renderer_class._instances_lock:
+            for renderer in renderer_class._instances.values():
+                renderer.close()
@@ -0,0 +1,98 @@
+"""
+Serve the mermaid, plugin and d3 bundles from ``_static`` instead of a CDN.
+
+With ``mermaid_vendor_assets`` pointing at a local package tree (a project with
+``node_modules``, or a directory of unpacked npm tarballs), each bundle is
+copied once per build into ``_static/_mermaid/<package>-<hash>/``. The hash is
+taken from the bundle's content, so the files can be served with immutable
+caching.
+"""
+
+from __future__ import annotations
+
+import json
+import os
+import shutil
+from hashlib import sha1
+
+from sphinx.util import logging
+from sphinx.util.osutil import ensuredir
+
+logger = logging.getLogger(__name__)
+
+#: Bundles that can be vendored: name -> (npm package, entry file, version config value).
+VENDOR_BUNDLES = {
+    "mermaid": ("mermaid", "dist/mermaid.esm.min.mjs", "mermaid_version"),
+    "elk": ("@mermaid-js/layout-elk", "dist/mermaid-layout-elk.esm.min.mjs", "mermaid_elk_version"),
+    "zenuml": ("@mermaid-js/mermaid-zenuml", "dist/mermaid-zenuml.esm.min.mjs", "mermaid_zenuml_version"),
+    "d3": ("d3", "dist/d3.min.js", "d3_version"),
+}
+
+
+def find_package(srcroot, package):
+    """Return the directory of an npm ``package`` below ``srcroot``, or None."""
+    for candidate in (os.path.join(srcroot, "node_modules", package), os.path.join(srcroot, package)):
+        if os.path.isfile(os.path.join(candidate, "package.json")):
+            return candidate
+    return None
+
+
+def vendor_bundle(srcroot, package, entry, staticdir):
+    """Copy one bundle into ``staticdir``.
+
+    Returns the entry path relative to ``staticdir`` and the package version,
+    or None when the package is not found.
+    """
+    pkgdir = find_package(srcroot, package)
+    if pkgdir is None or not os.path.isfile(os.path.join(pkgdir, entry)):
+        return None
+    with open(os.path.join(pkgdir, "package.json"), encoding="utf-8") as fp:
+        version = json.load(fp).get("version")
+    with open(os.path.join(pkgdir, entry), "rb") as fp:
+        digest = sha1(fp.read()).hexdigest()[:12]
+
+    # ESM builds import their chunks relatively, from dist/chunks/<entry stem>/.
+    # Chunk names are content-hashed too, so the entry's hash covers them.
+    entry_dir, entry_name = os.path.split(entry)
+    chunks = os.path.join(entry_dir, "chunks", entry_name.rsplit(".", 1)[0])
+    relroot = f"_mermaid/{package.rsplit('/', 1)[-1]}-{digest}"
+    target = os.path.join(staticdir, relroot)
+    if not os.path.isdir(target):
+        ensuredir(os.path.join(target, entry_dir))
+        shutil.copyfile(os.path.join(pkgdir, entry), os.path.join(target, entry))
+        if os.path.isdir(os.path.join(pkgdir, chunks)):
+            shutil.copytree(os.path.join(pkgdir, chunks), os.path.join(target, chunks))
+    return f"{relroot}/{entry}", version
+
+
+def vendor_assets(app):
+    """Copy the bundles the configuration needs; connected to ``builder-inited``.
+
+    The static paths of the vendored entries are stored in
+    ``env.mermaid_vendored_assets`` for :func:`install_js`.
+    """
+    app.env.mermaid_vendored_assets = {}
+    if not app.config.mermaid_vendor_assets or app.builder.format != "html":
+        return
+
+    srcroot = os.path.join(app.confdir, app.config.mermaid_vendor_assets)
+    staticdir = os.path.join(app.outdir, "_static")
+    wanted = {
+        "mermaid": True,
+        "elk": app.config.mermaid_include_elk,
+        "zenuml": app.config.mermaid_include_zenuml,
+        "d3": True,
+    }
+    for name, (package, entry, version_config) in VENDOR_BUNDLES.items():
+        if not wanted[name]:
+            continue
+        vendored = vendor_bundle(srcroot, package, entry, staticdir)
+        if vendored is None:
+            if name != "d3" or app.config.mermaid_d3_zoom:
+                logger.warning(f"{package!r} not found in mermaid_vendor_assets {srcroot!r}, loading it from the CDN")
+            continue
+        path, version = vendored
+        expected = getattr(app.config, version_config)
+        if expected not in ("", "latest") and version != expected:
+            logger.warning(f"vendored {package!r} is version {version}, but {version_config} is {expected!r}")
+        app.env.mermaid_vendored_assets[name] = path
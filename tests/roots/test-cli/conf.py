@@ -0,0 +1,7 @@
+import sys
+from pathlib import Path
+
+extensions = ["sphinxcontrib.mermaid"]
+exclude_patterns = ["_build"]
+mermaid_output_format = "svg"
+mermaid_cmd = [sys.executable, str(Path(__file__).parent / "mmdc_stub")]
@@ -0,0 +1,9 @@
+import sys
+from pathlib import Path
+
+extensions = ["sphinxcontrib.mermaid"]
+exclude_patterns = ["_build"]
+mermaid_output_format = "svg"
+mermaid_renderer = "daemon"
+mermaid_daemon_cmd = [sys.executable, str(Path(__file__).parent / "mermaid_daemon_fake")]
+mermaid_params = ["--theme", "forest"]
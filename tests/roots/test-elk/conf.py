@@ -0,0 +1,3 @@
+extensions = ["sphinxcontrib.mermaid"]
+exclude_patterns = ["_build"]
+mermaid_include_elk = True
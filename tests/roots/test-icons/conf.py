@@ -0,0 +1,8 @@
+extensions = ["sphinxcontrib.mermaid"]
+exclude_patterns = ["_build"]
+html_static_path = ["_static"]
+mermaid_icon_packs = {
+    "local": "icons.json",
+    "unused": "other.json",
+}
+mermaid_icon_subset = True
@@ -0,0 +1,18 @@
+import os
+import threading
+
+extensions = ["sphinxcontrib.mermaid"]
+exclude_patterns = ["_build"]
+mermaid_output_format = "svg"
+mermaid_render_ahead = 2
+
+LOG = os.path.join(os.path.dirname(os.path.abspath(__file__)), "renders.log")
+
+
+def renderer(code, fmt):
+    with open(LOG, "a") as fp:
+        fp.write(f"{os.getpid()} {threading.current_thread().name}\n")
+    return "<svg/>"
+
+
+mermaid_renderer = renderer
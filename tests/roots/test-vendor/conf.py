@@ -0,0 +1,3 @@
+extensions = ["sphinxcontrib.mermaid"]
+exclude_patterns = ["_build", "vendor"]
+mermaid_vendor_assets = "vendor"
@@ -0,0 +1,106 @@
+import json
+import sys
+from pathlib import Path
+
+import pytest
+
+from sphinxcontrib.mermaid.cli import main
+
+
+@pytest.fixture
+def cli_root(rootdir):
+    return str(Path(rootdir) / "test-cli")
+
+
+def test_prerender_and_check(cli_root, tmp_path):
+    cache = tmp_path / "cache"
+    assert main([cli_root, "--cache-dir", str(cache), "--check", "-q"]) == 1
+
+    assert main([cli_root, "--cache-dir", str(cache), "-j", "2", "-q"]) == 0
+    rendered = sorted(p.name for p in cache.iterdir())
+    assert len(rendered) == 3
+    assert all(name.startswith("mermaid-") and name.endswith(".svg") for name in rendered)
+
+    assert main([cli_root, "--cache-dir", str(cache), "--check", "-q"]) == 0
+
+
+def test_output_dir_and_formats(cli_root, tmp_path):
+    cache = tmp_path / "cache"
+    images = tmp_path / "_images"
+    assert main([cli_root, "--cache-dir", str(cache), "-o", str(images), "-f", "svg", "-f", "png", "-q"]) == 0
+    assert len(list(cache.glob("*.png"))) == 3
+    assert sorted(p.name for p in cache.iterdir()) == sorted(p.name for p in images.iterdir())
+
+
+def test_requires_destination(cli_root):
+    with pytest.raises(SystemExit):
+        main([cli_root, "-q"])
+
+
+@pytest.mark.sphinx("html", testroot="cli")
+def test_build_uses_prerendered_cache(app, tmp_path):
+    cache = tmp_path / "cache"
+    assert main([str(app.srcdir), "--cache-dir", str(cache), "-q"]) == 0
+
+    # A renderer that always fails proves the build only sees cache hits.
+    app.config.mermaid_cmd = [sys.executable, str(Path(__file__).parent / "roots/test-invalid/mmdc_fake")]
+    app.config.mermaid_cache_dir = str(cache)
+    app.builder.build_all()
+
+    assert "Mermaid exited with error" not in app._warning.getvalue()
+    images = sorted(p.name for p in (app.outdir / "_images").iterdir())
+    assert images == sorted(p.name for p in cache.iterdir())
+
+
+def test_sharded_manifest(cli_root, tmp_path):
+    manifest = tmp_path / "manifest.json"
+    assert main([cli_root, "--manifest", str(manifest), "-q"]) == 0
+    jobs = json.loads(manifest.read_text())["jobs"]
+    assert len(jobs) == 3
+    assert {job["format"] for job in jobs} == {"svg"}
+
+    shards = [tmp_path / "shard-1", tmp_path / "shard-2"]
+    for index, shard in enumerate(shards, 1):
+        assert main(["--from-manifest", str(manifest), "--shard", f"{index}/2", "--cache-dir", str(shard), "-q"]) == 0
+    rendered = [{p.name for p in shard.iterdir()} for shard in shards]
+    assert [len(names) for names in rendered] == [2, 1]
+    assert rendered[0] | rendered[1] == {job["filename"] for job in jobs}
+
+
+def test_shard_is_validated(cli_root, tmp_path):
+    with pytest.raises(SystemExit):
+        main([cli_root, "--cache-dir", str(tmp_path), "--shard", "3/2"])
+
+
+@pytest.mark.sphinx(
+    "html",
+    testroot="cli",
+    srcdir="render_manifest",
+    confoverrides={
+        "mermaid_cmd": [sys.executable, str(Path(__file__).parent / "roots/test-invalid/mmdc_fake")],
+        "mermaid_cache_dir": "_cache",
+        "mermaid_render_manifest": "_manifest.json",
+    },
+)
+def test_build_writes_render_manifest(app):
+    # Diagrams missing from the cache are not rendered but written to the manifest.
+    app.build(force_all=True)
+    assert "Mermaid exited with error" not in app._warning.getvalue()
+    assert not (app.outdir / "_images").exists()
+    manifest = app.confdir / "_manifest.json"
+    jobs = json.loads(manifest.read_text())["jobs"]
+    assert len(jobs) == 3
+    assert {docname for job in jobs for docname in job["docnames"]} == {"index"}
+
+    # Reading the project with the command line tool leaves the manifest alone.
+    defines = ["-D", "mermaid_cache_dir=_cache", "-D", "mermaid_render_manifest=_manifest.json"]
+    assert main([str(app.srcdir), *defines, "--check", "-q"]) == 1
+    assert json.loads(manifest.read_text())["jobs"] == jobs
+
+    stub = json.dumps([sys.executable, str(app.srcdir / "mmdc_stub")])
+    assert main(["--from-manifest", str(manifest), "--cache-dir", str(app.confdir / "_cache"), "-D", f"mermaid_cmd={stub}", "-q"]) == 0
+    # An incremental build rewrites the pages that showed the fallback.
+    app.build()
+    images = sorted(p.name for p in (app.outdir / "_images").iterdir())
+    assert images == sorted(job["filename"] for job in jobs)
+    assert json.loads(manifest.read_text())["jobs"] == []
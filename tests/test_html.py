@@ -1,9 +1,15 @@
+import io
 import re
 import sys
-from json import dumps
+import urllib.request
+from json import dumps, loads
 from pathlib import Path
 
 import pytest
+from yaml import dump
+
+from sphinxcontrib.mermaid.exceptions import MermaidError
+from sphinxcontrib.mermaid.icons import load_icon_pack
 
 
 @pytest.fixture
@@ -21,8 +27,9 @@ def index(app, build_all):
 def test_html_raw(index):
     assert "mermaid.run(" in index
     assert 'import mermaid from "https://cdn.jsdelivr.net/npm/mermaid@11.12.1/dist/mermaid.esm.min.mjs"' in index
-    assert 'import elkLayouts from "https://cdn.jsdelivr.net/npm/@mermaid-js/layout-elk@0.2.0/dist/mermaid-layout-elk.esm.min.mjs"' in index
-    assert "mermaid.registerLayoutLoaders(elkLayouts);" in index
+    # No diagram on the page uses an ELK layout
+    assert "layout-elk" not in index
+    assert "elkReady" not in index
     assert "mermaid.registerIconPacks" not in index
     assert '{"startOnLoad": false}' in index
     assert (
@@ -37,21 +44,49 @@ def test_html_zoom_option(index, app):
     assert "if (false) {\n        const mermaids_to_add_zoom" in index
     zoom_page = (app.outdir / "zoom.html").read_text().replace("<script >", "<script>")
     assert "svg.call(zoom);" in zoom_page
-    assert 'd3.selectAll(".mermaid[data-zoom-id=' in zoom_page
+    assert '.filter((el) => el.matches(".mermaid[data-zoom-id=' in zoom_page
     assert '] svg")' not in zoom_page
-    assert 'return this.querySelector("svg");' in zoom_page
+    assert '.map((el) => el.querySelector("svg"))' in zoom_page
     assert "if (true) {\n        const mermaids_to_add_zoom" in zoom_page
 
     # the first diagram has no id
     assert '<pre id="participants" class="mermaid">\n        sequenceDiagram' in zoom_page
 
 
+@pytest.mark.sphinx("html", testroot="basic")
+def test_html_zoom_ids_are_deterministic(app, build_all):
+    zoom_ids = re.findall(r'data-zoom-id="(id-[0-9a-f]{16})"', (app.outdir / "zoom.html").read_text())
+    assert len(zoom_ids) == 1
+
+    app.builder.build_all()
+    zoom_page = (app.outdir / "zoom.html").read_text()
+    assert re.findall(r'data-zoom-id="(id-[0-9a-f]{16})"', zoom_page) == zoom_ids
+    assert f".mermaid[data-zoom-id={zoom_ids[0]}]" in zoom_page
+
+
+@pytest.mark.sphinx("html", testroot="basic", confoverrides={"mermaid_d3_zoom": True, "mermaid_zoom_tile_threshold": 3000})
+def test_html_zoom_tiled_viewer(index):
+    assert "if (el.getElementsByTagName('*').length >= 3000) {\n        tiledZoom(el, svg, inner);" in index
+    # The fullscreen modal shares the zoom setup, and drops the page's tile canvas.
+    assert "if (svg.querySelector('g')) applyZoom(svg);" in index
+    assert "clone.querySelector('canvas.mermaid-tiles')?.remove();" in index
+    # Re-rendered diagrams release their tiles.
+    assert "disposeTiles(el);" in index
+
+
+@pytest.mark.sphinx("html", testroot="basic", confoverrides={"mermaid_d3_zoom": True})
+def test_html_zoom_without_tiled_viewer(index):
+    assert "tiledZoom" not in index
+    assert "disposeTiles" not in index
+    assert "applyZoom(this)" in index
+
+
 @pytest.mark.sphinx("html", testroot="basic", confoverrides={"mermaid_d3_zoom": True})
 def test_html_zoom_option_global(index):
     assert "mermaid.run(" in index
     assert "if (true) {\n        const mermaids_to_add_zoom" in index
-    assert 'd3.selectAll(".mermaid").select(function() {' in index
-    assert 'return this.querySelector("svg");' in index
+    assert '.filter((el) => el.matches(".mermaid"))' in index
+    assert '.map((el) => el.querySelector("svg"))' in index
     assert 'd3.selectAll(".mermaid svg")' not in index
 
 
@@ -86,13 +121,20 @@ def test_conf_mermaid_local(app, index):
 
 
 @pytest.mark.sphinx(
-    "html", testroot="basic", confoverrides={"mermaid_use_local": "test", "mermaid_include_elk": True, "mermaid_elk_use_local": "test"}
+    "html",
+    testroot="basic",
+    confoverrides={
+        "mermaid_use_local": "test",
+        "mermaid_include_elk": True,
+        "mermaid_elk_use_local": "test",
+        "mermaid_init_config": {"layout": "elk"},
+    },
 )
 def test_conf_mermaid_elk_local(app, index):
     assert "mermaid.run(" in index
     assert "mermaid.min.js" not in index
     assert "mermaid-layout-elk.esm.min.mjs" not in index
-    assert 'import elkLayouts from "./_static/test"' in index
+    assert 'const elkReady = import("./_static/test")' in index
 
 
 @pytest.mark.sphinx(
@@ -157,10 +199,57 @@ def test_mermaid_config(index):
     assert "cdn.jsdelivr.net/npm/d3" not in index
 
 
-@pytest.mark.sphinx("html", testroot="basic", confoverrides={"mermaid_include_elk": True, "mermaid_elk_version": "latest"})
+@pytest.mark.sphinx("html", testroot="config")
+def test_mermaid_sources_are_interned(app, index):
+    """The global config front matter is stored once, and doctrees only reference it."""
+    config_yaml = dump({"config": app.config.mermaid_config})
+    assert list(app.env.mermaid_sources.values()).count(config_yaml) == 1
+    assert len(app.env.mermaid_diagrams["index"]) == 2
+
+    doctree = (Path(app.doctreedir) / "index.doctree").read_bytes()
+    assert b"primaryColor" not in doctree
+    assert b"a --> b" not in doctree
+
+
+@pytest.mark.sphinx(
+    "html",
+    testroot="basic",
+    confoverrides={"mermaid_include_elk": True, "mermaid_elk_version": "latest", "mermaid_init_config": {"layout": "elk"}},
+)
 def test_mermaid_with_elk(app, index):
     assert "mermaid.run(" in index
-    assert 'import elkLayouts from "https://cdn.jsdelivr.net/npm/@mermaid-js/layout-elk/dist/mermaid-layout-elk.esm.min.mjs"' in index
+    assert 'const elkReady = import("https://cdn.jsdelivr.net/npm/@mermaid-js/layout-elk/dist/mermaid-layout-elk.esm.min.mjs")' in index
+    assert "mermaid.registerLayoutLoaders(elkLayouts)" in index
+    assert "await elkReady;" in index
+
+
+@pytest.mark.sphinx("html", testroot="elk")
+def test_elk_loaded_only_where_used(app, build_all):
+    elk_url = "https://cdn.jsdelivr.net/npm/@mermaid-js/layout-elk@0.2.0/dist/mermaid-layout-elk.esm.min.mjs"
+    for page in ("index", "init", "directive_config", "flowchart_elk", "default_renderer"):
+        assert f'const elkReady = import("{elk_url}")' in (app.outdir / f"{page}.html").read_text(), page
+    plain = (app.outdir / "plain.html").read_text()
+    assert "mermaid.run(" in plain
+    assert "layout-elk" not in plain
+
+
+@pytest.mark.sphinx(
+    "html",
+    testroot="basic",
+    confoverrides={"mermaid_include_elk": True, "mermaid_init_config": {"flowchart": {"defaultRenderer": "elk"}}},
+)
+def test_elk_default_renderer_from_init_config(index):
+    assert 'const elkReady = import("https://cdn.jsdelivr.net/npm/@mermaid-js/layout-elk@0.2.0/' in index
+
+
+@pytest.mark.sphinx(
+    "html",
+    testroot="basic",
+    srcdir="elk_default_renderer",
+    confoverrides={"mermaid_include_elk": True, "mermaid_config": {"flowchart": {"defaultRenderer": "elk"}}},
+)
+def test_elk_default_renderer_from_mermaid_config(index):
+    assert 'const elkReady = import("https://cdn.jsdelivr.net/npm/@mermaid-js/layout-elk@0.2.0/' in index
 
 
 @pytest.mark.sphinx("html", testroot="basic", confoverrides={"mermaid_include_zenuml": True, "mermaid_zenuml_version": "latest"})
@@ -175,8 +264,7 @@ def test_html_raw_from_markdown(index):
     assert "mermaid.run(" in index
     assert "mermaid.run(" in index
     assert 'import mermaid from "https://cdn.jsdelivr.net/npm/mermaid@11.12.1/dist/mermaid.esm.min.mjs"' in index
-    assert 'import elkLayouts from "https://cdn.jsdelivr.net/npm/@mermaid-js/layout-elk@0.2.0/dist/mermaid-layout-elk.esm.min.mjs"' in index
-    assert "mermaid.registerLayoutLoaders(elkLayouts);" in index
+    assert "layout-elk" not in index
     assert '{"startOnLoad": false}' in index
     assert (
         '<pre align="center" id="participants" class="mermaid align-center">\n            sequenceDiagram\n      participant Alice\n      participant Bob\n      Alice-&gt;John: Hello John, how are you?\n    </pre>'
@@ -199,6 +287,37 @@ def test_fullscreen_enabled(index):
     assert index.count("document.addEventListener('keydown'") == 1
 
 
+@pytest.mark.sphinx("html", testroot="fullscreen")
+def test_runtime_keeps_sources_once(index):
+    """Sources live in memory, and one delegated listener serves the fullscreen buttons."""
+    assert "data-original-code" not in index
+    assert "const _sources = new WeakMap();" in index
+    assert "addFullscreenButtons(_diagrams.filter(isProcessed));" in index
+    assert index.count("document.addEventListener('click'") == 1
+    assert "if (true) setupFullscreen();" in index
+
+
+@pytest.mark.sphinx("html", testroot="fullscreen")
+def test_fullscreen_button_clears_padded_pre(index):
+    """Buttons sit in a container, offset by the diagram's margin and padding."""
+    assert ".mermaid-container > pre {" in index
+    assert "top: 4px;" not in index
+    assert "container.className = 'mermaid-container';" in index
+    assert "(parseFloat(style.marginTop) || 0) + (parseFloat(style.paddingTop) || 0) + 4" in index
+    assert "(parseFloat(style.marginRight) || 0) + (parseFloat(style.paddingRight) || 0) + 4" in index
+    assert "fullscreenBtn.style.top = `${offsets[i][0]}px`;" in index
+    assert "fullscreenBtn.style.right = `${offsets[i][1]}px`;" in index
+
+
+@pytest.mark.sphinx("html", testroot="basic")
+def test_theme_detection_is_debounced(index):
+    """Theme checks run once per frame, skip unrelated style writes and follow prefers-color-scheme."""
+    assert "requestAnimationFrame(() => {\n            themeCheckScheduled = false;" in index
+    assert "themeStyle(target) !== themeStyles.get(target)" in index
+    assert "addEventListener('change', scheduleThemeCheck)" in index
+    assert "new MutationObserver(reRunIfThemeChanges)" not in index
+
+
 @pytest.mark.sphinx("html", testroot="basic", confoverrides={"mermaid_fullscreen": False})
 def test_fullscreen_disabled(index):
     """Test that fullscreen is not added when disabled."""
@@ -235,6 +354,19 @@ def test_lazy_rendering_code_present(index):
     assert "svgs.size() !== mermaids_to_add_zoom" not in index
 
 
+@pytest.mark.sphinx("html", testroot="basic")
+def test_time_sliced_rendering_code_present(index):
+    """The initial render goes through the serialized queue one diagram at a time."""
+    assert "const generation = ++_renderGeneration;" in index
+    assert "_renderQueue = _renderQueue.then(() => renderTimeSliced(visible, generation));" in index
+    assert "const renderTimeSliced = async (elements, generation) => {\n    if (generation !== _renderGeneration) return;" in index
+    assert "await timed('render', el, () => mermaid.run({ nodes: [el] }));" in index
+    assert "mermaid.run({ nodes: visible })" not in index
+    assert "globalThis.scheduler.yield()" in index
+    assert "requestIdleCallback" in index
+    assert ".sort((a, b) => a[0] - b[0])" in index
+
+
 @pytest.mark.sphinx("html", testroot="basic")
 def test_mermaid_theme_defaults(index):
     """Default theme values are 'dark' and 'default'."""
@@ -330,3 +462,159 @@ def test_static_png_has_mermaid_class(app, monkeypatch):
     index = (app.outdir / "index.html").read_text()
 
     assert re.search(r'<img src="diagram\.png"[^>]* class="mermaid"', index)
+
+
+@pytest.mark.sphinx("html", testroot="vendor", confoverrides={"mermaid_d3_zoom": True})
+def test_vendored_assets(app, index):
+    vendored = app.env.mermaid_vendored_assets
+    assert set(vendored) == {"mermaid", "d3"}
+    mermaid_js = vendored["mermaid"]
+    assert re.fullmatch(r"_mermaid/mermaid-[0-9a-f]{12}/dist/mermaid\.esm\.min\.mjs", mermaid_js)
+    static = app.outdir / "_static"
+    assert (static / mermaid_js).is_file()
+    assert (static / mermaid_js).parent.joinpath("chunks", "mermaid.esm.min", "chunk-TEST.mjs").is_file()
+    assert (static / vendored["d3"]).is_file()
+
+    assert f'import mermaid from "./_static/{mermaid_js}"' in index
+    assert f'<link rel="modulepreload" href="./_static/{mermaid_js}">' in index
+    assert "cdn.jsdelivr.net/npm/mermaid" not in index
+    assert "cdn.jsdelivr.net/npm/d3" not in index
+    assert f"_static/{vendored['d3']}" in index
+
+    plain = (app.outdir / "plain.html").read_text()
+    assert "modulepreload" not in plain
+
+
+@pytest.mark.sphinx("html", testroot="vendor", confoverrides={"mermaid_version": "10.9.0"})
+def test_vendored_assets_version_mismatch(app, build_all, warning):
+    assert "vendored 'mermaid' is version 11.12.1, but mermaid_version is '10.9.0'" in warning.getvalue()
+
+
+@pytest.mark.sphinx("html", testroot="icons")
+def test_conf_mermaid_icon_subset(app, index):
+    subset_path = app.env.mermaid_icon_subsets["local"]
+    assert set(app.env.mermaid_icon_subsets) == {"local"}
+    subset = loads((app.outdir / "_static" / subset_path).read_text())
+    assert set(subset["icons"]) == {"server", "database"}
+    assert subset["aliases"] == {"db": {"parent": "database"}}
+    assert "categories" not in subset
+
+    assert f'"local": "./_static/{subset_path}"' in index
+    assert '"unused"' not in index
+    plain = (app.outdir / "plain.html").read_text()
+    assert "mermaid.registerIconPacks" not in plain
+
+
+@pytest.mark.sphinx("html", testroot="icons", srcdir="icons_download")
+def test_icon_pack_download_is_cached(app, monkeypatch):
+    downloads = []
+
+    def urlopen(url, timeout):
+        downloads.append(url)
+        return io.BytesIO(b'{"prefix": "remote", "icons": {}}')
+
+    monkeypatch.setattr(urllib.request, "urlopen", urlopen)
+    url = "https://example.com/icons.json"
+    # Without mermaid_cache_dir, the pack is kept next to the doctrees.
+    assert load_icon_pack(app, url) == load_icon_pack(app, url) == {"prefix": "remote", "icons": {}}
+    assert downloads == [url]
+
+
+def svg_renderer(code, fmt):
+    return f"<svg>{fmt}</svg>"
+
+
+@pytest.mark.sphinx(
+    "html",
+    testroot="basic",
+    srcdir="auto_pages",
+    confoverrides={"mermaid_output_format": "auto", "mermaid_renderer": svg_renderer, "mermaid_auto_policy": {"pages": ["zoom"]}},
+)
+def test_auto_format_pages(app, index):
+    assert '<pre id="participants" class="mermaid">' in index
+    assert "mermaid.run(" in index
+
+    # Every diagram of the page was prerendered, mermaid is not loaded.
+    zoom_page = (app.outdir / "zoom.html").read_text()
+    assert '<object data="_images/mermaid-' in zoom_page
+    assert 'class="mermaid"' not in zoom_page
+    assert "mermaid.run(" not in zoom_page
+    assert "cdn.jsdelivr.net/npm/mermaid" not in zoom_page
+
+
+@pytest.mark.sphinx(
+    "html",
+    testroot="basic",
+    srcdir="auto_size",
+    confoverrides={
+        "mermaid_output_format": "auto",
+        "mermaid_renderer": svg_renderer,
+        "mermaid_auto_policy": {"min_size": None, "min_statements": 4, "format": "png"},
+    },
+)
+def test_auto_format_size(app, index):
+    # The sequence diagram is large enough to be prerendered, the empty class diagram is not.
+    assert re.search(r'<img src="_images/mermaid-[0-9a-f]+\.png"', index)
+    assert '<pre id="participants" class="mermaid">' not in index
+    assert '<pre  class="mermaid">\n        classDiagram\n    </pre>' in index
+    assert "mermaid.run(" in index
+
+
+def prerender_zoom_page(docname, code):
+    return docname == "zoom"
+
+
+@pytest.mark.sphinx(
+    "html",
+    testroot="basic",
+    srcdir="auto_prerender",
+    confoverrides={
+        "mermaid_output_format": "auto",
+        "mermaid_renderer": svg_renderer,
+        "mermaid_auto_policy": {"prerender": f"{__name__}.prerender_zoom_page"},
+    },
+    warningiserror=True,
+)
+def test_auto_format_prerender_path(app):
+    app.build(force_all=True)
+    assert app.statuscode == 0
+    assert not app._warning.getvalue()
+
+    assert '<pre id="participants" class="mermaid">' in (app.outdir / "index.html").read_text()
+    assert '<object data="_images/mermaid-' in (app.outdir / "zoom.html").read_text()
+
+
+def failing_renderer(code, fmt):
+    raise MermaidError("Parse error")
+
+
+@pytest.mark.sphinx(
+    "html",
+    testroot="basic",
+    srcdir="auto_fallback",
+    confoverrides={"mermaid_output_format": "auto", "mermaid_renderer": failing_renderer, "mermaid_auto_policy": {"min_size": 0}},
+)
+def test_auto_format_falls_back_to_raw(app, index):
+    assert '<pre id="participants" class="mermaid">' in index
+    assert "mermaid.run(" in index
+
+
+@pytest.mark.sphinx("html", testroot="basic", confoverrides={"mermaid_perf": True})
+def test_perf_instrumentation(index):
+    assert "window.mermaidPerf = mermaidPerf;" in index
+    assert "performance.measure(name, `${name}:start`, `${name}:end`);" in index
+    assert "timed('render', el, () => mermaid.run({ nodes: [el] }))" in index
+    assert 'window.dispatchEvent(new CustomEvent("mermaid:perf", { detail: mermaidPerf.summary() }));' in index
+
+
+@pytest.mark.sphinx("html", testroot="basic", confoverrides={"mermaid_perf": True, "mermaid_perf_event": None})
+def test_perf_instrumentation_without_event(index):
+    assert "window.mermaidPerf = mermaidPerf;" in index
+    assert "dispatchEvent" not in index
+
+
+@pytest.mark.sphinx("html", testroot="basic")
+def test_perf_instrumentation_disabled(index):
+    assert "mermaidPerf" not in index
+    assert "performance.measure" not in index
+    assert "const timed = (kind, el, fn) => fn();" in index
@@ -0,0 +1,640 @@
+import json
+import os
+import socket
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from types import SimpleNamespace
+
+import pytest
+
+from sphinxcontrib.mermaid import mermaid, render, render_diagram, render_diagrams
+from sphinxcontrib.mermaid.exceptions import MermaidError, MermaidRendererCrashed, MermaidRendererUnavailable, MermaidRenderTimeout
+from sphinxcontrib.mermaid.render import RENDER_DEFAULTS, CircuitBreaker, RenderQueue, _cairosvg, canonical_code, render_key, render_to
+from sphinxcontrib.mermaid.renderers import DaemonRenderer, HTTPRenderer, Renderer, default_daemon_state_file, get_renderer
+
+DAEMON_FAKE = Path(__file__).parent / "roots/test-daemon/mermaid_daemon_fake"
+
+
+class RenderHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):
+        self.server.peers.add(self.client_address)
+        self.server.paths.append(self.path)
+        code = self.rfile.read(int(self.headers["Content-Length"]))
+        status, body = (500, b"Parse error") if b"invalid" in code else (200, b"<svg>" + code + b"</svg>")
+        self.send_response(status)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def render_server():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), RenderHandler)
+    server.peers = set()
+    server.paths = []
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def http_renderer(server):
+    return HTTPRenderer(f"http://127.0.0.1:{server.server_address[1]}/mermaid/{{format}}")
+
+
+def test_http_renderer_reuses_connection(render_server, tmp_path):
+    renderer = http_renderer(render_server)
+    for i in range(3):
+        renderer.render(f"graph LR\n  A{i}-->B", "svg", tmp_path / f"{i}.svg", None)
+    renderer.close()
+
+    assert (tmp_path / "2.svg").read_bytes() == b"<svg>graph LR\n  A2-->B</svg>"
+    assert render_server.paths == ["/mermaid/svg"] * 3
+    assert len(render_server.peers) == 1
+
+
+def test_http_renderer_concurrent_requests(render_server, tmp_path):
+    renderer = http_renderer(render_server)
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        list(executor.map(lambda i: renderer.render(f"graph LR\n  A{i}-->B", "png", tmp_path / f"{i}.png", None), range(12)))
+    renderer.close()
+
+    assert len(list(tmp_path.glob("*.png"))) == 12
+    assert 1 <= len(render_server.peers) <= 4
+
+
+def test_http_renderer_errors(render_server, tmp_path):
+    with pytest.raises(MermaidError, match="returned HTTP 500:\nParse error"):
+        http_renderer(render_server).render("invalid", "svg", tmp_path / "out.svg", None)
+
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+    with pytest.raises(MermaidRendererUnavailable):
+        HTTPRenderer(f"http://127.0.0.1:{port}/").render("graph LR", "svg", tmp_path / "out.svg", None)
+
+
+def test_get_renderer():
+    config = SimpleNamespace(mermaid_renderer="http", mermaid_renderer_url="http://localhost:8000/{format}")
+    assert get_renderer(config) is get_renderer(config)
+
+    with pytest.raises(MermaidError, match="mermaid_renderer must be one of"):
+        get_renderer(SimpleNamespace(mermaid_renderer="kroki"))
+
+
+@pytest.mark.sphinx(
+    "html",
+    testroot="basic",
+    srcdir="callable_renderer",
+    confoverrides={"mermaid_output_format": "svg", "mermaid_renderer": lambda code, fmt: f"<svg>{fmt}</svg>"},
+    warningiserror=True,
+)
+def test_callable_renderer(app):
+    app.build(force_all=True)
+    assert app.statuscode == 0
+    assert not app._warning.getvalue()
+
+    rendered = list((app.outdir / "_images").glob("mermaid-*.svg"))
+    assert rendered
+    assert all(p.read_text() == "<svg>svg</svg>" for p in rendered)
+    assert '<object data="_images/mermaid-' in (app.outdir / "index.html").read_text()
+
+
+@pytest.fixture
+def daemon_renderer(tmp_path):
+    renderer = DaemonRenderer([sys.executable, str(DAEMON_FAKE)], str(tmp_path / "daemon.json"), idle_timeout=30)
+    yield renderer
+    renderer.stop()
+
+
+def daemon_config(*params):
+    return SimpleNamespace(mermaid_params=list(params), mermaid_sequence_config=None)
+
+
+def test_daemon_renderer_is_started_once_and_reused(daemon_renderer, tmp_path):
+    daemon_renderer.render("graph LR", "svg", tmp_path / "a.svg", daemon_config("-t", "neutral"))
+    pid = json.loads(Path(daemon_renderer.state_file).read_text())["pid"]
+
+    # The next build connects to the running daemon instead of starting one.
+    next_build = DaemonRenderer(["command-that-does-not-exist"], daemon_renderer.state_file)
+    next_build.render("graph TD", "png", tmp_path / "b.png", daemon_config())
+    next_build.close()
+
+    assert (tmp_path / "a.svg").read_text() == f"<svg><!-- {pid} svg neutral --></svg>"
+    assert (tmp_path / "b.png").read_text() == f"<svg><!-- {pid} png default --></svg>"
+
+
+def test_daemon_renderer_errors(daemon_renderer, tmp_path):
+    with pytest.raises(MermaidError, match="Parse error on line 1"):
+        daemon_renderer.render("invalid", "svg", tmp_path / "out.svg", daemon_config())
+
+    with pytest.raises(MermaidRendererUnavailable, match="mermaid_daemon_cmd"):
+        DaemonRenderer(["command-that-does-not-exist"], str(tmp_path / "other.json")).render("graph LR", "svg", tmp_path / "out.svg", daemon_config())
+
+
+@pytest.mark.skipif(os.name == "nt", reason="checks POSIX file modes")
+def test_daemon_state_file_must_be_private(daemon_renderer, tmp_path):
+    daemon_renderer.render("graph LR", "svg", tmp_path / "a.svg", daemon_config())
+    state_file = Path(daemon_renderer.state_file)
+    assert state_file.stat().st_mode & 0o777 == 0o600
+
+    state_file.chmod(0o644)
+    # A readable state file is not trusted, and a new daemon would be started.
+    next_build = DaemonRenderer(["command-that-does-not-exist"], daemon_renderer.state_file)
+    with pytest.raises(MermaidRendererUnavailable, match="mermaid_daemon_cmd"):
+        next_build.render("graph LR", "svg", tmp_path / "b.svg", daemon_config())
+    state_file.chmod(0o600)
+
+
+@pytest.mark.skipif(os.name == "nt", reason="checks POSIX file modes")
+def test_default_daemon_state_file(tmp_path, monkeypatch):
+    monkeypatch.setenv("XDG_RUNTIME_DIR", str(tmp_path))
+    (tmp_path / "sphinxcontrib-mermaid").mkdir(mode=0o755)
+
+    state_file = Path(default_daemon_state_file())
+    assert state_file == tmp_path / "sphinxcontrib-mermaid" / "daemon.json"
+    assert state_file.parent.stat().st_mode & 0o777 == 0o700
+
+
+def test_daemon_idle_timeout(tmp_path):
+    renderer = DaemonRenderer([sys.executable, str(DAEMON_FAKE)], str(tmp_path / "daemon.json"), idle_timeout=0.3)
+    renderer.render("graph LR", "svg", tmp_path / "a.svg", daemon_config())
+    first = (tmp_path / "a.svg").read_text()
+
+    deadline = time.monotonic() + 10
+    while Path(renderer.state_file).exists() and time.monotonic() < deadline:
+        time.sleep(0.05)
+    assert not Path(renderer.state_file).exists()
+
+    # The pooled connection is stale; a fresh daemon is started transparently.
+    renderer.render("graph LR", "svg", tmp_path / "b.svg", daemon_config())
+    renderer.stop()
+    assert (tmp_path / "b.svg").read_text() != first
+
+
+@pytest.mark.sphinx("html", testroot="daemon")
+def test_daemon_build(app, tmp_path):
+    app.config.mermaid_daemon_state_file = str(tmp_path / "daemon.json")
+    try:
+        app.builder.build_all()
+    finally:
+        DaemonRenderer.from_config(app.config).stop()
+
+    rendered = list((app.outdir / "_images").glob("mermaid-*.svg"))
+    assert len(rendered) == 2
+    assert all("svg forest" in p.read_text() for p in rendered)
+
+
+# Stands in for mmdc starting a browser: spawns a child, writes its pid and hangs.
+HANGING_MMDC = """
+import subprocess, sys, time
+child = subprocess.Popen([sys.executable, "-c", "import time; time.sleep(60)"])
+open(sys.argv[1], "w").write(str(child.pid))
+open(sys.argv[sys.argv.index("-o") + 1], "w").write("partial")
+time.sleep(60)
+"""
+
+
+def render_config(**overrides):
+    config = {
+        "mermaid_renderer": "mmdc",
+        "mermaid_cmd_shell": False,
+        "mermaid_params": [],
+        "mermaid_sequence_config": None,
+        "mermaid_verbose": False,
+        "mermaid_render_timeout": None,
+        "mermaid_render_retries": 0,
+        "mermaid_svg_convert": False,
+    }
+    config.update(overrides)
+    return SimpleNamespace(**config)
+
+
+def assert_exited(pid):
+    deadline = time.monotonic() + 5
+    while time.monotonic() < deadline:
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            return
+        # Reaped by init once its parent is gone.
+        time.sleep(0.05)
+    pytest.fail("the renderer's child process is still running")
+
+
+@pytest.mark.skipif(os.name == "nt", reason="checks the process group with os.kill")
+def test_command_renderer_timeout_kills_process_tree(tmp_path):
+    pidfile = tmp_path / "child.pid"
+    config = render_config(mermaid_cmd=[sys.executable, "-c", HANGING_MMDC, str(pidfile)], mermaid_render_timeout=1)
+
+    start = time.monotonic()
+    with pytest.raises(MermaidRenderTimeout, match="did not finish within 1 seconds"):
+        render_to("graph LR", "", "svg", str(tmp_path), config)
+    assert time.monotonic() - start < 30
+
+    assert_exited(int(pidfile.read_text()))
+    # The partial output is not left behind to be taken for a cached render.
+    assert not list(tmp_path.glob("mermaid-*.svg"))
+
+
+@pytest.mark.skipif(os.name == "nt", reason="checks the process group with os.kill")
+def test_command_renderer_interrupt_kills_process_tree(tmp_path, monkeypatch):
+    pidfile = tmp_path / "child.pid"
+    config = render_config(mermaid_cmd=[sys.executable, "-c", HANGING_MMDC, str(pidfile)])
+    communicate = subprocess.Popen.communicate
+
+    def interrupted(self, input=None, timeout=None):
+        if input is None:
+            return communicate(self, input, timeout)
+        while not pidfile.exists() or not pidfile.read_text():
+            time.sleep(0.05)
+        raise KeyboardInterrupt
+
+    monkeypatch.setattr(subprocess.Popen, "communicate", interrupted)
+    with pytest.raises(KeyboardInterrupt):
+        render_to("graph LR", "", "svg", str(tmp_path), config)
+    assert_exited(int(pidfile.read_text()))
+
+
+def test_render_retries(tmp_path):
+    calls = []
+
+    def flaky(code, fmt):
+        calls.append(code)
+        if "invalid" in code:
+            raise MermaidError("Parse error")
+        if len(calls) < 3:
+            raise MermaidRendererCrashed("crashed")
+        return "<svg/>"
+
+    with pytest.raises(MermaidRendererCrashed, match="crashed"):
+        render_to("graph LR", "", "svg", str(tmp_path), render_config(mermaid_renderer=flaky, mermaid_render_retries=1))
+    assert len(calls) == 2
+
+    outfn = render_to("graph LR", "", "svg", str(tmp_path), render_config(mermaid_renderer=flaky, mermaid_render_retries=1))
+    assert len(calls) == 3
+    assert Path(outfn).read_text() == "<svg/>"
+
+    # A syntax error is not the renderer's fault, and is rendered once.
+    with pytest.raises(MermaidError, match="Parse error"):
+        render_to("invalid", "", "svg", str(tmp_path), render_config(mermaid_renderer=flaky, mermaid_render_retries=3))
+    assert len(calls) == 4
+
+
+@pytest.mark.skipif(os.name == "nt", reason="runs a shell script as mermaid_pdfcrop")
+@pytest.mark.sphinx(
+    "latex",
+    testroot="basic",
+    srcdir="pdfcrop_timeout",
+    confoverrides={"mermaid_renderer": lambda code, fmt: b"%PDF-1.4", "mermaid_render_timeout": 1},
+)
+def test_pdfcrop_timeout(app, tmp_path):
+    pdfcrop = tmp_path / "pdfcrop"
+    pdfcrop.write_text("#!/bin/sh\nsleep 60\n")
+    pdfcrop.chmod(0o755)
+    app.config.mermaid_pdfcrop = str(pdfcrop)
+
+    start = time.monotonic()
+    with pytest.raises(MermaidRenderTimeout, match="PdfCrop did not finish within 1 seconds"):
+        app.build(force_all=True)
+    assert time.monotonic() - start < 30
+
+
+def test_circuit_breaker(tmp_path):
+    calls = []
+
+    def hanging(code, fmt):
+        calls.append(code)
+        if "invalid" in code:
+            raise MermaidError("Parse error")
+        raise MermaidRenderTimeout("timed out")
+
+    breaker = CircuitBreaker(2)
+    config = render_config(mermaid_renderer=hanging)
+    for code in ("graph A", "invalid", "graph B"):
+        with pytest.raises(MermaidError):
+            render_to(code, "", "svg", str(tmp_path), config, breaker=breaker)
+    # The syntax error shows the renderer works and resets the count.
+    assert not breaker.open
+    with pytest.raises(MermaidRenderTimeout):
+        render_to("graph C", "", "svg", str(tmp_path), config, breaker=breaker)
+    assert breaker.open
+
+    assert render_to("graph D", "", "svg", str(tmp_path), config, breaker=breaker) is None
+    assert calls == ["graph A", "invalid", "graph B", "graph C"]
+
+
+def timing_out_renderer(code, fmt):
+    raise MermaidRenderTimeout("timed out")
+
+
+@pytest.mark.sphinx(
+    "html",
+    testroot="basic",
+    srcdir="fallback_raw",
+    confoverrides={"mermaid_output_format": "svg", "mermaid_renderer": timing_out_renderer, "mermaid_render_max_failures": 1},
+)
+def test_render_fallback_raw(app):
+    app.builder.build_all()
+
+    index = (app.outdir / "index.html").read_text()
+    assert '<pre id="participants" class="mermaid">' in index
+    assert "mermaid.run(" in index
+    # The diagrams rendered at build time are not handed to mermaid.run().
+    assert 'querySelectorAll("pre.mermaid")' in index
+    assert "not rendered (see mermaid_render_max_failures)" in app._warning.getvalue()
+
+
+@pytest.mark.sphinx(
+    "html",
+    testroot="basic",
+    srcdir="fallback_placeholder",
+    confoverrides={
+        "mermaid_output_format": "svg",
+        "mermaid_renderer": timing_out_renderer,
+        "mermaid_render_fallback": "placeholder",
+    },
+)
+def test_render_fallback_placeholder(app):
+    app.builder.build_all()
+
+    index = (app.outdir / "index.html").read_text()
+    assert '<pre class="mermaid-placeholder">' in index
+    assert "mermaid.run(" not in index
+
+
+def svg_renderer(code, fmt):
+    return "<svg/>"
+
+
+@pytest.mark.sphinx(
+    "html",
+    testroot="basic",
+    srcdir="prune_images",
+    confoverrides={"mermaid_output_format": "svg", "mermaid_renderer": svg_renderer, "mermaid_prune_images": "dry-run"},
+)
+def test_prune_images(app, monkeypatch):
+    images = app.outdir / "_images"
+    images.mkdir(parents=True)
+    kept = Path(app.doctreedir) / "mermaid"
+    kept.mkdir(parents=True)
+    stale = [images / f"mermaid-{'a' * 40}.svg", images / f"mermaid-{'b' * 40}-crop.pdf", kept / f"mermaid-{'c' * 40}.svg"]
+    for path in [*stale, images / "unrelated.png"]:
+        path.write_text("old")
+
+    # A diagram another extension adds to a document without the directive.
+    (app.srcdir / "generated.rst").write_text("Generated\n=========\n")
+
+    def add_diagram(app, doctree):
+        if app.env.docname == "generated":
+            doctree += mermaid(code="graph TD\n  Generated-->Diagram", options={})
+
+    app.connect("doctree-read", add_diagram)
+    app.build(force_all=True)
+    live = set(images.glob("mermaid-*.svg")) - set(stale)
+    assert len(live) == 4
+    assert all(path.exists() for path in stale)
+    assert "3 orphaned mermaid images (0 KiB) would be removed" in app._status.getvalue()
+    # An SVG kept for mermaid_svg_convert by an earlier build.
+    kept_live = kept / next(iter(live)).name
+    kept_live.write_text("<svg/>")
+
+    # An incremental build that rewrites nothing still knows the live images,
+    # without loading any doctree.
+    app.config.mermaid_prune_images = True
+    # As in a new sphinx-build process, which has rendered nothing yet.
+    app.builder.mermaid_images = set()
+    monkeypatch.setattr(app.env, "get_doctree", lambda docname: pytest.fail(f"{docname} doctree loaded"))
+    app.build()
+    assert not any(path.exists() for path in stale)
+    assert set(images.glob("mermaid-*")) == live
+    assert kept_live.exists()
+    assert (images / "unrelated.png").exists()
+    assert "removed 3 orphaned mermaid images" in app._status.getvalue()
+
+
+class RecordingRenderer:
+    def __init__(self, svg='<svg xmlns="http://www.w3.org/2000/svg" width="20" height="10"><rect width="20" height="10"/></svg>'):
+        self.svg = svg
+        self.formats = []
+
+    def __call__(self, code, fmt):
+        self.formats.append(fmt)
+        return self.svg if fmt == "svg" else f"{fmt} from mmdc"
+
+
+def test_svg_convert_without_cairosvg(tmp_path, monkeypatch):
+    monkeypatch.setitem(sys.modules, "cairosvg", None)
+    renderer = RecordingRenderer()
+    config = render_config(mermaid_renderer=renderer, mermaid_svg_convert=True)
+
+    outfn = render_to("graph LR", "", "png", str(tmp_path / "out"), config, svgdir=str(tmp_path / "svg"))
+    assert Path(outfn).read_text() == "png from mmdc"
+    assert renderer.formats == ["png"]
+
+
+def test_svg_convert_with_cache(tmp_path, monkeypatch):
+    def svg2png(bytestring, write_to, **kwargs):
+        Path(write_to).write_bytes(b"png from cairosvg")
+
+    monkeypatch.setitem(sys.modules, "cairosvg", SimpleNamespace(svg2png=svg2png))
+    renderer = RecordingRenderer()
+    config = render_config(mermaid_renderer=renderer, mermaid_svg_convert=True)
+    cache = tmp_path / "cache"
+
+    # The SVG is kept in the cache, as the build does with mermaid_cache_dir.
+    outfn = render_to("sequenceDiagram\n  A->>B: hi", "", "png", str(tmp_path / "out"), config, str(cache), svgdir=str(cache))
+    assert Path(outfn).read_bytes() == b"png from cairosvg"
+    assert renderer.formats == ["svg"]
+    assert sorted(p.suffix for p in cache.iterdir()) == [".png", ".svg"]
+
+
+@pytest.mark.skipif(_cairosvg() is None, reason="cairosvg or the cairo library is not installed")
+def test_svg_convert(tmp_path):
+    renderer = RecordingRenderer()
+    config = render_config(mermaid_renderer=renderer, mermaid_svg_convert=True)
+
+    code = "%%{init: {'flowchart': {'htmlLabels': false}}}%%\ngraph LR"
+    png = render_to(code, "", "png", str(tmp_path / "html"), config, svgdir=str(tmp_path / "svg"))
+    pdf = render_to(code, "", "pdf", str(tmp_path / "latex"), config, svgdir=str(tmp_path / "svg"))
+    assert renderer.formats == ["svg"]
+    assert Path(png).read_bytes().startswith(b"\x89PNG")
+    assert Path(pdf).read_bytes().startswith(b"%PDF")
+
+    # HTML labels are lost by cairo, such diagrams are rendered by mmdc.
+    renderer = RecordingRenderer('<svg xmlns="http://www.w3.org/2000/svg"><foreignObject/></svg>')
+    config.mermaid_renderer = renderer
+    png = render_to("graph TD", "", "png", str(tmp_path / "html"), config, svgdir=str(tmp_path / "svg"))
+    assert renderer.formats == ["png"]
+    assert Path(png).read_text() == "png from mmdc"
+
+
+def test_svg_convert_renders_once(tmp_path, monkeypatch):
+    """Each diagram runs the renderer once across svg, png and pdf builds."""
+
+    def svg2png(bytestring, write_to, **kwargs):
+        Path(write_to).write_bytes(b"png from cairosvg")
+
+    monkeypatch.setitem(sys.modules, "cairosvg", SimpleNamespace(svg2png=svg2png))
+    renderer = RecordingRenderer('<svg xmlns="http://www.w3.org/2000/svg"><foreignObject/></svg>')
+    config = render_config(mermaid_renderer=renderer, mermaid_svg_convert=True)
+    svgdir = str(tmp_path / "doctrees" / "mermaid")
+
+    # Flowcharts have HTML labels by default: png is rendered directly.
+    png = render_to("graph LR", "", "png", str(tmp_path / "html"), config, svgdir=svgdir)
+    assert renderer.formats == ["png"]
+    assert Path(png).read_text() == "png from mmdc"
+    assert not os.path.exists(svgdir)
+
+    # Turned off in the configFile of mermaid_params, png is converted.
+    config_file = tmp_path / "mermaid.json"
+    config_file.write_text('{"htmlLabels": false}')
+    renderer = RecordingRenderer()
+    config = render_config(mermaid_renderer=renderer, mermaid_svg_convert=True, mermaid_params=["-c", str(config_file)])
+    render_to("graph TD", "", "png", str(tmp_path / "html"), config, svgdir=svgdir)
+    assert renderer.formats == ["svg"]
+
+    # An SVG build reuses the kept SVG, and keeps what it renders for conversions.
+    svg = render_to("graph TD", "", "svg", str(tmp_path / "svg_html"), config, svgdir=svgdir)
+    render_to("sequenceDiagram\n  A->>B: hi", "", "svg", str(tmp_path / "svg_html"), config, svgdir=svgdir)
+    render_to("sequenceDiagram\n  A->>B: hi", "", "png", str(tmp_path / "html"), config, svgdir=svgdir)
+    assert renderer.formats == ["svg", "svg"]
+    assert Path(svg).read_text() == renderer.svg
+
+
+def test_render_key_ignores_formatting():
+    config = render_config()
+    code = "---\ntitle: Flow\nconfig:\n  theme: dark\n  look: classic\n---\nflowchart LR\n  %% first edge\n  A --> B\n"
+    reformatted = (
+        "\n    ---\r\n    config:\r\n      look: classic\r\n      theme: dark\r\n    title: Flow\r\n    ---\r\n"
+        "    flowchart LR  \r\n      A --> B\r\n      %% an edited comment\r\n\r\n"
+    )
+    assert canonical_code(reformatted) == canonical_code(code)
+    assert render_key(reformatted, {}, config) == render_key(code, {}, config)
+
+    # Directives, relative indentation and the diagram itself still count.
+    assert render_key(code + "%%{init: {'theme': 'forest'}}%%", {}, config) != render_key(code, {}, config)
+    assert render_key("mindmap\n  root\n    child", {}, config) != render_key("mindmap\n  root\n  child", {}, config)
+    assert render_key(code.replace("dark", "neutral"), {}, config) != render_key(code, {}, config)
+
+
+@pytest.mark.sphinx("html", testroot="basic")
+def test_render_defaults_match_config(app):
+    for name, default in RENDER_DEFAULTS.items():
+        assert getattr(app.config, name) == default, name
+
+
+def test_render_diagram(tmp_path):
+    calls = []
+
+    def renderer(code, fmt):
+        calls.append(code)
+        return "<svg/>"
+
+    config = {"mermaid_renderer": renderer, "mermaid_cache_dir": "cache"}
+    result = render_diagram("graph LR\n  A --> B", config=config, confdir=str(tmp_path))
+    assert result.path == str(tmp_path / "cache" / result.filename)
+    assert result.filename == f"mermaid-{result.key}.svg"
+    assert (result.format, result.cached) == ("svg", False)
+
+    # Shared with builds using the same cache, and insensitive to formatting.
+    again = render_diagram("graph LR\r\n  A --> B  \r\n", config=config, confdir=str(tmp_path))
+    assert again.cached
+    assert again.path == result.path
+    assert len(calls) == 1
+
+    with pytest.raises(MermaidError, match="no destination"):
+        render_diagram("graph LR", config={"mermaid_renderer": renderer})
+
+
+def test_render_diagrams(tmp_path):
+    calls = []
+
+    def renderer(code, fmt):
+        calls.append(code)
+        if "invalid" in code:
+            raise MermaidError("bad syntax")
+        return b"png"
+
+    codes = ["graph A", "invalid", "graph B", "graph A"]
+    results = render_diagrams(codes, "png", {"mermaid_renderer": renderer}, outdir=str(tmp_path), jobs=2)
+    assert [result.format for result in results] == ["png"] * 4
+    assert [result.error is None for result in results] == [True, False, True, True]
+    assert str(results[1].error) == "bad syntax"
+    assert results[1].path is None
+    assert results[0] == results[3]
+    assert sorted(calls) == ["graph A", "graph B", "invalid"]
+
+
+class BrowserRenderer(Renderer):
+    local_browser = True
+
+    def __init__(self):
+        self.running = 0
+        self.peak = 0
+        self._lock = threading.Lock()
+
+    def render(self, code, fmt, outfn, config):
+        with self._lock:
+            self.running += 1
+            self.peak = max(self.peak, self.running)
+        time.sleep(0.05)
+        with self._lock:
+            self.running -= 1
+        Path(outfn).write_text("<svg/>")
+
+
+def test_browser_slots_shared(tmp_path, monkeypatch):
+    monkeypatch.setattr(render, "BROWSER_SLOTS", threading.BoundedSemaphore(2))
+    renderer = BrowserRenderer()
+    config = render_config(mermaid_renderer=renderer, mermaid_render_max_failures=0)
+
+    # A render-ahead queue and an extension rendering at the same time.
+    queue = RenderQueue(4, config, str(tmp_path / "build"))
+    for i in range(4):
+        queue.submit(f"graph LR\n  Build{i}", {}, "svg")
+    render_diagrams([f"graph LR\n  Api{i}" for i in range(4)], "svg", vars(config), outdir=str(tmp_path / "api"), jobs=4)
+    queue.finish()
+    assert renderer.peak == 2
+
+
+def _render_log(app):
+    return sorted((app.srcdir / "renders.log").read_text().splitlines())
+
+
+@pytest.mark.sphinx("html", testroot="render-ahead", srcdir="render_ahead")
+def test_render_ahead(app):
+    app.build(force_all=True)
+
+    # Every diagram was rendered once, by the background queue.
+    renders = _render_log(app)
+    assert len(renders) == 7
+    assert all(line.startswith(f"{os.getpid()} mermaid-render") for line in renders)
+    assert len(list((app.outdir / "_images").iterdir())) == 7
+    assert '<object data="_images/mermaid-' in (app.outdir / "page3.html").read_text()
+
+    # The queue is reused by the next build.
+    app.build(force_all=True)
+    assert len(_render_log(app)) == 7
+
+
+@pytest.mark.sphinx("html", testroot="render-ahead", srcdir="render_ahead_parallel", parallel=2)
+def test_render_ahead_parallel(app):
+    app.build(force_all=True)
+
+    # Documents read by worker processes are queued in the main process.
+    renders = _render_log(app)
+    assert len(renders) == 7
+    assert all(line.startswith(f"{os.getpid()} mermaid-render") for line in renders)
+    assert len(list((app.outdir / "_images").iterdir())) == 7